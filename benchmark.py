@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import platform
+import resource
+import traceback
+import subprocess
+import numpy as np
+from optparse import OptionParser
+
+## The Indexer only works on databases in this directory
+DB_ROOT = '/var/lib/philologic/databases/'
+## Bumped whenever the meaning of a reported number changes
+SCHEMA = 1
+MEASURES = ('frequency', 'tf_idf', 'bm25')
+SCORINGS = ('simple_scoring', 'dismax_scoring')
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_word(word_id):
+    """Distinct pseudo-word of at least two letters for each id"""
+    word_id += len(LETTERS)
+    letters = []
+    while word_id:
+        word_id, letter = divmod(word_id, len(LETTERS))
+        letters.append(LETTERS[letter])
+    return ''.join(reversed(letters))
+
+def zipf_sampler(vocabulary, exponent, random):
+    """Return a function drawing word ids whose frequencies follow Zipf's law"""
+    weights = 1.0 / np.arange(1, vocabulary + 1) ** exponent
+    cumulative = np.cumsum(weights / weights.sum())
+    return lambda size: np.minimum(np.searchsorted(cumulative, random.random_sample(size)), vocabulary - 1)
+
+def generate_corpus(name, docs, words_per_doc=1000, vocabulary=20000, exponent=1.07, divs=4, seed=0):
+    """Write a synthetic database with the files read by the Indexer and DocInfo:
+    WORK/<doc>.words.sorted, WORK/all.frequencies, TEXT/<doc>.txt and toms.db.
+    The same arguments always give the same database."""
+    db_path = DB_ROOT + name + '/'
+    if os.path.isdir(db_path):
+        shutil.rmtree(db_path)
+    os.makedirs(db_path + 'WORK')
+    os.makedirs(db_path + 'TEXT')
+    random = np.random.RandomState(seed)
+    sample = zipf_sampler(vocabulary, exponent, random)
+    words = [make_word(word_id) for word_id in xrange(vocabulary)]
+    word_order = np.argsort(np.array(words))
+    alphabetical_rank = np.empty(vocabulary, dtype=np.int64)
+    alphabetical_rank[word_order] = np.arange(vocabulary)
+    frequencies = np.zeros(vocabulary, dtype=np.int64)
+    toms = []
+    for doc in xrange(1, docs + 1):
+        word_ids = sample(words_per_doc)
+        frequencies += np.bincount(word_ids, minlength=vocabulary)
+        tokens = [words[word_id] for word_id in word_ids]
+        offsets = np.cumsum([0] + [len(token) + 1 for token in tokens[:-1]])
+        text_file = open(db_path + 'TEXT/doc%d.txt' % doc, 'w')
+        text_file.write(' '.join(tokens))
+        text_file.close()
+        div_size = max(1, -(-words_per_doc // divs))
+        output = open(db_path + 'WORK/doc%d.words.sorted' % doc, 'w')
+        for position in np.lexsort((np.arange(words_per_doc), alphabetical_rank[word_ids])):
+            output.write('word\t%s\t%d %d 1 0 %d %d %d %d\n' % (tokens[position], doc, position // div_size + 1,
+                         position // 50 + 1, position // 15 + 1, position, offsets[position]))
+        output.close()
+        toms.append(('doc', '', '%d 0 0 0 0 0 0' % doc, len(toms), 'Document %d' % doc, 'doc%d.txt' % doc,
+                     'Title %d' % doc, 'Author %d' % (doc % 50)))
+        for div in xrange(1, min(divs, words_per_doc) + 1):
+            toms.append(('div1', '', '%d %d 0 0 0 0 0' % (doc, div), len(toms), 'Chapter %d of document %d' % (div, doc),
+                         None, None, None))
+    output = open(db_path + 'WORK/all.frequencies', 'w')
+    for word_id in np.lexsort((alphabetical_rank, -frequencies)):
+        if frequencies[word_id]:
+            output.write('%d %s\n' % (frequencies[word_id], words[word_id]))
+    output.close()
+    conn = sqlite3.connect(db_path + 'toms.db')
+    conn.execute('create table toms (philo_type, philo_name, philo_id, philo_seq, head, filename, title, author)')
+    conn.executemany('insert into toms values (?,?,?,?,?,?,?,?)', toms)
+    conn.execute('create index philo_id_index on toms(philo_id)')
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def percentiles(latencies):
+    """Latency percentiles in milliseconds"""
+    latencies = np.asarray(latencies) * 1000
+    if not len(latencies):
+        return {}
+    return dict(('p%d' % percent, float(np.percentile(latencies, percent))) for percent in (50, 90, 99))
+
+def run_in_child(function, *args):
+    """Run function in a forked process, so that its peak RSS is its own,
+    and return its result with the peak RSS in kB"""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_end)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        try:
+            result = function(*args)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        output = os.fdopen(write_end, 'w')
+        output.write(json.dumps(result))
+        output.close()
+        os._exit(0)
+    os.close(write_end)
+    reader = os.fdopen(read_end)
+    result = reader.read()
+    reader.close()
+    os.waitpid(pid, 0)
+    if not result:
+        return {'error': 'benchmark process died'}
+    return json.loads(result)
+
+def timed_queries(function, queries):
+    """Call function on each query and return throughput and latency results"""
+    latencies = []
+    started = time.time()
+    for query in queries:
+        query_start = time.time()
+        function(query)
+        latencies.append(time.time() - query_start)
+    seconds = time.time() - started
+    return {'seconds': seconds, 'count': len(queries), 'throughput': len(queries) / seconds if seconds else 0.0,
+            'unit': 'queries/s', 'latency_ms': percentiles(latencies)}
+
+
+class Benchmark(object):
+    """Generates a synthetic database for each corpus size and times indexing,
+    KNN computation, ranked search in every measure and scoring, KNN lookups
+    and mapper lookups on it, each stage in its own process"""
+
+    def __init__(self, sizes=(100, 1000), words_per_doc=1000, vocabulary=20000, exponent=1.07, queries=200,
+                 limit_results=20, workers=1, depth=0, seed=0, keep=False, stemmer=False):
+        self.config = {'sizes': list(sizes), 'words_per_doc': words_per_doc, 'vocabulary': vocabulary,
+                       'exponent': exponent, 'queries': queries, 'limit_results': limit_results,
+                       'workers': workers, 'depth': depth, 'seed': seed, 'stemmer': stemmer}
+        self.keep = keep
+
+    def run(self):
+        results = []
+        for docs in self.config['sizes']:
+            name = 'benchmark_%d' % docs
+            stages = [('generate', self.generate), ('index', self.index), ('knn', self.knn),
+                      ('search', self.search), ('knn_search', self.knn_search), ('mapper', self.mapper)]
+            for stage, function in stages:
+                print >> sys.stderr, 'Running %s on %d documents' % (stage, docs)
+                outcome = run_in_child(function, name, docs)
+                for variant, result in sorted(outcome.get('variants', {'': outcome}).iteritems()):
+                    result.update({'stage': stage, 'variant': variant, 'docs': docs})
+                    result.setdefault('peak_rss_kb', outcome['peak_rss_kb'])
+                    results.append(result)
+                if 'error' in outcome:
+                    print >> sys.stderr, outcome['error']
+                    break
+            if not self.keep and os.path.isdir(DB_ROOT + name):
+                shutil.rmtree(DB_ROOT + name)
+        return {'schema': SCHEMA, 'environment': environment(), 'config': self.config, 'results': results}
+
+    def generate(self, name, docs):
+        started = time.time()
+        generate_corpus(name, docs, self.config['words_per_doc'], self.config['vocabulary'],
+                        self.config['exponent'], seed=self.config['seed'])
+        seconds = time.time() - started
+        words = docs * self.config['words_per_doc']
+        return {'seconds': seconds, 'count': words, 'throughput': words / seconds, 'unit': 'words/s'}
+
+    def index(self, name, docs):
+        from vectorize import Indexer
+        started = time.time()
+        Indexer(name, depth=self.config['depth'], workers=self.config['workers'],
+                stemmer=self.config['stemmer']).index_docs()
+        seconds = time.time() - started
+        words = docs * self.config['words_per_doc']
+        return {'seconds': seconds, 'count': words, 'throughput': words / seconds, 'unit': 'words/s'}
+
+    def knn(self, name, docs):
+        from vectorize import KNN_stored
+        started = time.time()
+        knn_stored = KNN_stored(name, limit_results=self.config['limit_results'], workers=self.config['workers'])
+        rows = len(knn_stored.objects)
+        knn_stored.store_results()
+        seconds = time.time() - started
+        return {'seconds': seconds, 'count': rows, 'throughput': rows / seconds, 'unit': 'objects/s'}
+
+    def search(self, name, docs):
+        from ranked_relevance import Searcher
+        queries = self.query_words()
+        variants = {}
+        for measure in MEASURES:
+            for scoring in SCORINGS:
+                for intersect in (False, True):
+                    search = lambda query: Searcher(query, name, stemmer=self.config['stemmer']).search(measure, scoring, intersect)
+                    variants['%s/%s/%s' % (measure, scoring, intersect and 'intersect' or 'union')] = timed_queries(search, queries)
+        return {'variants': variants}
+
+    def knn_search(self, name, docs):
+        from knn_helper import knn
+        neighbors = knn(name)
+        random = np.random.RandomState(self.config['seed'])
+        obj_ids = [str(doc) + ' 1' * self.config['depth'] for doc in random.randint(1, docs + 1, self.config['queries'])]
+        return timed_queries(neighbors.search, obj_ids)
+
+    def mapper(self, name, docs):
+        from word_mapper import mapper
+        words = mapper(DB_ROOT + name + '/')
+        queries = [word for query in self.query_words() for word in query.split()]
+
+        def lookup(word):
+            ## small corpora lack some of the query words
+            word_id = words[word]
+            if word_id is not None:
+                words[word_id]
+        return timed_queries(lookup, queries)
+
+    def query_words(self):
+        """Queries of one to three words, drawn from the corpus distribution"""
+        random = np.random.RandomState(self.config['seed'] + 1)
+        sample = zipf_sampler(self.config['vocabulary'], self.config['exponent'], random)
+        lengths = random.randint(1, 4, self.config['queries'])
+        return [' '.join(make_word(word_id) for word_id in sample(length)) for length in lengths]
+
+
+def environment():
+    """What the numbers of a run depend on besides the code"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN'), 'commit': commit}
+
+def compare(baseline, results):
+    """Return the throughput, p50 latency and peak RSS ratios of results over
+    a baseline run, for each stage, variant and corpus size in both"""
+    key = lambda result: (result['stage'], result['variant'], result['docs'])
+    previous = dict((key(result), result) for result in baseline['results'])
+    ratios = []
+    for result in results['results']:
+        if key(result) not in previous or 'error' in result:
+            continue
+        old = previous[key(result)]
+        ratio = {'stage': result['stage'], 'variant': result['variant'], 'docs': result['docs']}
+        if old.get('throughput'):
+            ratio['throughput'] = result['throughput'] / old['throughput']
+        if old.get('latency_ms', {}).get('p50'):
+            ratio['latency_p50'] = result['latency_ms']['p50'] / old['latency_ms']['p50']
+        if old.get('peak_rss_kb'):
+            ratio['peak_rss'] = result['peak_rss_kb'] / old['peak_rss_kb']
+        ratios.append(ratio)
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='100,1000', help='comma separated numbers of documents')
+    parser.add_option('--words-per-doc', type='int', default=1000)
+    parser.add_option('--vocabulary', type='int', default=20000)
+    parser.add_option('--exponent', type='float', default=1.07, help='Zipf exponent of the vocabulary')
+    parser.add_option('--queries', type='int', default=200)
+    parser.add_option('--limit-results', type='int', default=20)
+    parser.add_option('--workers', type='int', default=1)
+    parser.add_option('--depth', type='int', default=0)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--stemmer', default=False, help='index and search with this PyStemmer language')
+    parser.add_option('--keep', action='store_true', default=False, help='keep the generated databases')
+    parser.add_option('--output', help='write the results to this file instead of stdout')
+    parser.add_option('--compare', help='results of a previous run to compare with')
+    options, args = parser.parse_args()
+    benchmark = Benchmark([int(size) for size in options.sizes.split(',')], options.words_per_doc, options.vocabulary,
+                          options.exponent, options.queries, options.limit_results, options.workers, options.depth,
+                          options.seed, options.keep, options.stemmer)
+    results = benchmark.run()
+    if options.compare:
+        results['comparison'] = compare(json.load(open(options.compare)), results)
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
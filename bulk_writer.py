@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import time
+import sqlite3
+import threading
+from Queue import Queue
+from instrument import NULL_INSTRUMENT
+
+## Pragmas used while loading: no rollback journal and no fsync, since a failed
+## load is simply rerun, a large page cache and temporary b-trees in memory.
+LOAD_PRAGMAS = (
+    'PRAGMA page_size = 4096',
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -262144',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA locking_mode = EXCLUSIVE',
+)
+
+## Restored once the load is done, so that readers see a regular database
+FINAL_PRAGMAS = (
+    'PRAGMA locking_mode = NORMAL',
+    'PRAGMA journal_mode = DELETE',
+    'PRAGMA synchronous = FULL',
+)
+
+
+class BulkWriter(object):
+    """Loads rows into a SQLite database from a background thread.
+    Rows are grouped in batches inserted with executemany, and indexes
+    are only built once every row is loaded.
+
+    writer = BulkWriter(db_file)
+    writer.execute('create table hits (word text, freq int)')
+    writer.create_index('create index word_index on hits(word)')
+    writer.insert('hits', (word, freq))
+    writer.close()
+
+    With an instrument, the time spent waiting for the writer thread to take
+    a batch is added to its write_wait timer, and loaded rows to rows_inserted."""
+
+    def __init__(self, db_file, batch_size=10000, queue_size=16, text_factory=str, pragmas=LOAD_PRAGMAS,
+                 instrument=NULL_INSTRUMENT):
+        self.db_file = db_file
+        self.instrument = instrument
+        self.batch_size = batch_size
+        self.text_factory = text_factory
+        self.pragmas = pragmas
+        self.batches = {}
+        self.indexes = []
+        self.rows = 0
+        self.error = None
+        self.queue = Queue(queue_size)
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.__load)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __load(self):
+        """Writer thread: the connection is created and used only here"""
+        conn = sqlite3.connect(self.db_file)
+        conn.text_factory = self.text_factory
+        c = conn.cursor()
+        done = False
+        try:
+            for pragma in self.pragmas:
+                c.execute(pragma)
+            while True:
+                statement, rows = self.queue.get()
+                if statement is None:
+                    done = True
+                    break
+                if rows is None:
+                    c.execute(statement)
+                else:
+                    c.executemany(statement, rows)
+            conn.commit()
+            for statement in self.indexes:
+                c.execute(statement)
+            conn.commit()
+            for pragma in FINAL_PRAGMAS:
+                c.execute(pragma)
+        except Exception, error:
+            self.error = error
+            ## keep consuming so that the producer never blocks on a full queue
+            while not done:
+                done = self.queue.get()[0] is None
+        finally:
+            c.close()
+            conn.close()
+
+    def __put(self, statement, rows=None):
+        if self.error is not None:
+            raise self.error
+        with self.instrument.timer('write_wait'):
+            self.queue.put((statement, rows))
+
+    def execute(self, statement):
+        """Run a statement, such as create table, in load order"""
+        self.flush()
+        self.__put(statement)
+
+    def create_index(self, statement):
+        """Run a create index statement once all rows are loaded"""
+        self.indexes.append(statement)
+
+    def insert(self, table, row):
+        if table not in self.batches:
+            self.batches[table] = []
+        batch = self.batches[table]
+        batch.append(row)
+        if len(batch) >= self.batch_size:
+            self.__put('insert into %s values (%s)' % (table, ','.join('?' * len(row))), batch)
+            self.batches[table] = []
+        self.rows += 1
+
+    def insert_many(self, table, rows):
+        for row in rows:
+            self.insert(table, row)
+
+    def flush(self):
+        for table, batch in self.batches.items():
+            if batch:
+                self.__put('insert into %s values (%s)' % (table, ','.join('?' * len(batch[0]))), batch)
+        self.batches = {}
+
+    def close(self):
+        """Load the remaining rows, build the indexes and report the load rate"""
+        self.flush()
+        self.queue.put((None, None))
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.instrument.count('rows_inserted', self.rows)
+        elapsed = time.time() - self.started
+        rate = self.rows / elapsed if elapsed else self.rows
+        print '%d rows loaded in %s in %.1f seconds (%d rows/s)' % (self.rows, self.db_file, elapsed, rate)
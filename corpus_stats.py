@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import json
+import sqlite3
+import zipfile
+import numpy as np
+from cStringIO import StringIO
+from os import path
+
+loaded_stats = {}
+
+
+class CorpusStats(object):
+    """Number of indexed objects, their lengths in words, their average length
+    and the vocabulary size of a database. Computed by the Indexer and stored in
+    corpus_stats.npz so that searches don't have to recompute them."""
+
+    def __init__(self, obj_ids=(), lengths=(), vocabulary=0, depth=0):
+        self.obj_ids = list(obj_ids)
+        self.lengths = list(lengths)
+        self.vocabulary = vocabulary
+        self.depth = depth
+        self.length_index = None
+        self.update()
+
+    def add(self, obj_id, length):
+        """Record the length of an object during indexing"""
+        self.obj_ids.append(obj_id)
+        self.lengths.append(length)
+
+    def update(self):
+        self.doc_count = float(len(self.obj_ids))
+        if self.obj_ids:
+            self.avg_length = float(sum(self.lengths) / len(self.lengths))
+        else:
+            self.avg_length = 0.0
+        self.length_index = None
+
+    def length(self, obj_id):
+        if self.length_index is None:
+            self.length_index = dict(zip(self.obj_ids, self.lengths))
+        return self.length_index[obj_id]
+
+    def save(self, db_path):
+        self.update()
+        save_npz(db_path + 'corpus_stats.npz', obj_ids=np.array(self.obj_ids, dtype=str),
+                 lengths=np.array(self.lengths, dtype=np.int64),
+                 scalars=np.array([self.vocabulary, self.depth], dtype=np.int64))
+
+    @classmethod
+    def load(cls, db_path):
+        stats = np.load(db_path + 'corpus_stats.npz')
+        vocabulary, depth = stats['scalars']
+        return cls(stats['obj_ids'].tolist(), stats['lengths'].tolist(), int(vocabulary), int(depth))
+
+    @classmethod
+    def from_hits(cls, db_path):
+        """Recompute the statistics of a database indexed before they were stored,
+        or return None if it has no hits_per_word.sqlite"""
+        if not path.isfile(db_path + 'hits_per_word.sqlite'):
+            return None
+        conn = sqlite3.connect(db_path + 'hits_per_word.sqlite')
+        conn.text_factory = str
+        c = conn.cursor()
+        tables = [row[0] for row in c.execute("select name from sqlite_master where type='table'")]
+        if 'doc_hits' in tables:
+            c.execute('select doc_id, total_words from doc_hits group by doc_id')
+            depth = 0
+        else:
+            c.execute('select obj_id, total_words from obj_hits group by obj_id')
+            depth = 1
+        rows = c.fetchall()
+        c.close()
+        return cls([str(obj_id) for obj_id, length in rows], [length for obj_id, length in rows],
+                   word_count(db_path), depth)
+
+    @classmethod
+    def from_postings(cls, db_path):
+        """Same as from_hits, from the doc numbers and lengths of the postings"""
+        postings_path = db_path + 'postings/'
+        if not path.isfile(postings_path + 'meta.json'):
+            return None
+        depth = json.load(open(postings_path + 'meta.json'))['depth']
+        obj_ids = [line.rstrip('\n') for line in open(postings_path + 'docs.txt')]
+        return cls(obj_ids, np.load(postings_path + 'lengths.npy').tolist(), word_count(db_path), depth)
+
+
+def word_count(db_path):
+    """Vocabulary size written by the Indexer in word_num.txt"""
+    try:
+        return int(open(db_path + 'word_num.txt').readline().rstrip())
+    except IOError:
+        return 0
+
+
+def save_npz(file_name, **arrays):
+    """Same as np.savez, but with fixed timestamps so that the same
+    arrays always give the same file"""
+    archive = zipfile.ZipFile(file_name, 'w', zipfile.ZIP_STORED)
+    for name in sorted(arrays):
+        output = StringIO()
+        np.save(output, arrays[name])
+        archive.writestr(zipfile.ZipInfo(name + '.npy', date_time=(1980, 1, 1, 0, 0, 0)), output.getvalue())
+    archive.close()
+
+def corpus_stats(db_path):
+    """Return the statistics of a database, loaded once per process
+    and reloaded when the Indexer writes new ones"""
+    stats_file = db_path + 'corpus_stats.npz'
+    mtime = path.getmtime(stats_file) if path.isfile(stats_file) else None
+    if db_path not in loaded_stats or loaded_stats[db_path][0] != mtime:
+        if mtime is None:
+            ## databases indexed before the statistics were stored, or not indexed at all
+            stats = CorpusStats.from_hits(db_path) or CorpusStats.from_postings(db_path) or CorpusStats()
+        else:
+            stats = CorpusStats.load(db_path)
+        loaded_stats[db_path] = (mtime, stats)
+    return loaded_stats[db_path][1]
@@ -3,7 +3,57 @@
 import numpy as np
 import sqlite3
 import re
-from os import listdir
+import threading
+from collections import OrderedDict
+from os import listdir, path as os_path
+from sparse_store import SparseMatrix, has_sparse_matrix
+from corpus_stats import CorpusStats, corpus_stats
+
+sparse_matrices = {}
+connection_pool = threading.local()
+philo_dbs = {}
+doc_lengths = {}
+
+
+class LRUCache(object):
+    """Dictionary which keeps at most size entries, dropping the least recently used.
+    on_evict is called with each dropped value."""
+
+    def __init__(self, size=10000, on_evict=None):
+        self.size = size
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.size:
+                key, value = self.entries.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            if self.on_evict is not None:
+                for value in self.entries.itervalues():
+                    self.on_evict(value)
+            self.entries.clear()
 
 
 def np_load(obj_id, path, normalize=True, top=0, lower=None):
@@ -12,34 +62,106 @@ def np_load(obj_id, path, normalize=True, top=0, lower=None):
         return np_array[top:lower]/np_array[top:lower].sum()
     else:
         return np_array[top:lower]
-          
+
+def sparse_load(obj_id, path, normalize=True, top=0, lower=None):
+    """Same as np_load for a row of the sparse matrix stored in path.
+    obj_ids can be given with spaces or dashes."""
+    return load_sparse_matrix(path).row(obj_id.replace('-', ' '), normalize, top, lower)
+
+def file_mtime(path):
+    """Modification time of a file, None if it doesn't exist"""
+    try:
+        return os_path.getmtime(path)
+    except OSError:
+        return None
+
+def load_sparse_matrix(path):
+    """Memory-map the sparse matrix in path once per process,
+    and again when the Indexer writes a new one"""
+    mtime = file_mtime(path + 'meta.json')
+    if path not in sparse_matrices or sparse_matrices[path][0] != mtime:
+        sparse_matrices[path] = (mtime, SparseMatrix(path))
+    return sparse_matrices[path][1]
+
+def load_arrays(path, normalize=True):
+    """Return the obj_ids and the matrix of all the arrays stored in path,
+    which holds either a sparse matrix or one .npy file per object"""
+    if has_sparse_matrix(path):
+        sparse_matrix = load_sparse_matrix(path)
+        return sparse_matrix.obj_ids, sparse_matrix.matrix(normalize)
+    objects = [doc.replace('.npy', '') for doc in listdir(path)]
+    matrix = np.vstack([np_load(obj, path, normalize=normalize) for obj in objects])
+    return [obj.replace('-', ' ') for obj in objects], matrix
+
+def load_topic_matrix(db_path, normalize=False):
+    """Return the obj_ids and the memory-mapped (documents x topics) matrix written by
+    Mallet.parse_topics_in_docs, or the per-document arrays of older topic models.
+    Normalizing divides each row by its sum and copies the matrix."""
+    topic_path = db_path + 'topic_model/'
+    if not os_path.isfile(topic_path + 'doc_topics.npy'):
+        return load_arrays(topic_path + 'topic_arrays/', normalize)
+    obj_ids = [line.rstrip('\n') for line in open(topic_path + 'doc_topics.txt')]
+    matrix = np.load(topic_path + 'doc_topics.npy', mmap_mode='r')
+    if normalize:
+        matrix = matrix / matrix.sum(axis=1)[:, None]
+    return obj_ids, matrix
+
+def obj_arrays_path(db_path):
+    """Directory of the object arrays written by the Indexer"""
+    if has_sparse_matrix(db_path + 'obj_matrix/'):
+        return db_path + 'obj_matrix/'
+    return db_path + 'obj_arrays/'
+
 def sqlite_conn(path):
     conn = sqlite3.connect(path)
     conn.text_factory = str
     return conn.cursor()
 
+def pooled_conn(path):
+    """Return a cursor on a read-only connection to path which is opened
+    once per thread and reused by every later call, until the file changes.
+    Unlike sqlite3.connect, a missing file is never created."""
+    if not hasattr(connection_pool, 'connections'):
+        connection_pool.connections = {}
+    mtime = file_mtime(path)
+    if mtime is None:
+        raise IOError('no such database: %s' % path)
+    if path not in connection_pool.connections or connection_pool.connections[path][0] != mtime:
+        if path in connection_pool.connections:
+            connection_pool.connections[path][1].close()
+        conn = sqlite3.connect(path)
+        conn.text_factory = str
+        conn.execute('PRAGMA query_only = ON')
+        connection_pool.connections[path] = (mtime, conn)
+    return connection_pool.connections[path][1].cursor()
+
 def doc_enumerator(path, docs_only=True):
     if docs_only:
         suffix = re.compile('(\d+).+')
         return [int(suffix.sub('\\1', doc)) for doc in listdir(path + 'doc_arrays/')]
+    elif has_sparse_matrix(path + 'obj_matrix/'):
+        return [obj_id.replace(' ', '-') for obj_id in load_sparse_matrix(path + 'obj_matrix/').obj_ids]
     else:
         suffix = re.compile('\.npy')
         return [suffix.sub('', doc) for doc in listdir(path + 'obj_arrays/')]
     
 def doc_counter(path):
+    if has_sparse_matrix(path):
+        return float(len(load_sparse_matrix(path)))
     return float(len(listdir(path)))
     
 def words_in_doc(path, doc_id):
-    import philologic.PhiloDB
-    db = philologic.PhiloDB.PhiloDB(path,7)
-    filename = db.toms[doc_id]["filename"] + '.count'
-    doc = path + 'WORK/' + filename
-    return int(open(doc).readline().rstrip())
+    if (path, doc_id) not in doc_lengths:
+        if path not in philo_dbs:
+            import philologic.PhiloDB
+            philo_dbs[path] = philologic.PhiloDB.PhiloDB(path,7)
+        filename = philo_dbs[path].toms[doc_id]["filename"] + '.count'
+        doc = path + 'WORK/' + filename
+        doc_lengths[(path, doc_id)] = int(open(doc).readline().rstrip())
+    return doc_lengths[(path, doc_id)]
        
 def uniq_words_in_db(path):
-    return int(open(path + 'word_num.txt').readline().rstrip())
+    return corpus_stats(path).vocabulary
     
 def avg_doc_length(path):
-    word_count = uniq_words_in_db(path)
-    doc_num = doc_counter(path)
-    return float(word_count / doc_num)
\ No newline at end of file
+    return corpus_stats(path).avg_length
\ No newline at end of file
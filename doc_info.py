@@ -4,18 +4,30 @@
 from philologic import PhiloDB, SqlToms
 import re
 import time
-import sqlite3
 import unicodedata
-from difflib import get_close_matches
+from os import path as os_path
+from data_handler import LRUCache, pooled_conn
+from headword_index import headword_index
+
+## SQLite refuses statements with more than 999 parameters
+MAX_PARAMETERS = 999
+## Depth of philo_ids in toms.db
+PHILO_ID_DEPTH = 7
 
 
 class DocInfo(object):
     """Helper class meant to provide various information on documents.
     It provides various convenience functions based on the PhiloLogic library"""
     
-    def __init__(self, db, query=None, path='/var/lib/philologic/databases/'):
+    def __init__(self, db, query=None, path='/var/lib/philologic/databases/', open_files=32, cached_rows=100000):
         self.db_path = path + db
         self.toms = SqlToms.SqlToms(self.db_path +'/toms.db', 7)
+        self.philo_db = None
+        self.hitlists = {}
+        self.text_files = LRUCache(open_files, on_evict=lambda text_file: text_file.close())
+        self.toms_rows = LRUCache(cached_rows)
+        self.offsets_file = self.db_path + '/hit_offsets.sqlite'
+        self.has_offsets = os_path.isfile(self.offsets_file)
         
         if query:
             self.query = query.split()
@@ -23,17 +35,85 @@ class DocInfo(object):
             self.cut_begin = re.compile('\A[^ ]* ')
             self.cut_end = re.compile('<*[^ ]* [^ ]*\Z')
             self.word = 0
-            self.philo_search()
+            ## With the hit offsets written by the Indexer, PhiloLogic is only queried
+            ## for objects without recorded offsets
+            if self.has_offsets:
+                self.offset_words = self.indexed_words(self.query)
+            else:
+                self.philo_search()
             
     def philo_search(self):
         """Query the PhiloLogic database and retrieve a hitlist"""
-        db = PhiloDB.PhiloDB(self.db_path,7)
-        self.hitlist = db.query(self.query[self.word])
-        time.sleep(.05)
-        self.hitlist.update()
+        self.hitlist = self.word_hitlist(self.query[self.word])
+
+    def word_hitlist(self, word):
+        """Return the hitlist of a word, queried once per DocInfo"""
+        if word not in self.hitlists:
+            if self.philo_db is None:
+                self.philo_db = PhiloDB.PhiloDB(self.db_path,7)
+            hitlist = self.philo_db.query(word)
+            time.sleep(.05)
+            hitlist.update()
+            self.hitlists[word] = hitlist
+        return self.hitlists[word]
         
     def get_metadata(self, obj_id, field):
+        if isinstance(obj_id, basestring):
+            return self.get_metadata_many([obj_id], [field])[obj_id][field]
         return self.__get_info(obj_id=obj_id, field=field)
+
+    def get_metadata_many(self, obj_ids, fields):
+        """Return a dict of the fields of each obj_id, where a field missing from
+        an object is taken from its closest ancestor, like get_metadata does.
+        The rows of all objects and ancestors are read at once and cached."""
+        prefixes = {}
+        for obj_id in obj_ids:
+            levels = obj_id.replace('-', ' ').split()
+            prefixes[obj_id] = [self.__philo_id(levels[:level]) for level in xrange(len(levels), 0, -1)]
+        ## rows are read from the cache once, then kept here, since fetching the
+        ## missing ones may evict them from the cache
+        toms_rows = {}
+        missing = set()
+        for prefix in set(prefix for obj_prefixes in prefixes.itervalues() for prefix in obj_prefixes):
+            row = self.toms_rows.get(prefix)
+            if row is None:
+                missing.add(prefix)
+            else:
+                toms_rows[prefix] = row
+        toms_rows.update(self.__fetch_rows(missing))
+        metadata = {}
+        for obj_id, obj_prefixes in prefixes.iteritems():
+            rows = [toms_rows[prefix] for prefix in obj_prefixes]
+            metadata[obj_id] = {}
+            for field in fields:
+                info = None
+                for row in rows:
+                    info = row.get(field)
+                    if isinstance(info, str):
+                        break
+                metadata[obj_id][field] = info
+        return metadata
+
+    def __philo_id(self, levels):
+        return ' '.join(levels + ['0'] * (PHILO_ID_DEPTH - len(levels)))
+
+    def __fetch_rows(self, philo_ids):
+        """Return and cache the toms rows of philo_ids, with an empty row for ids not in toms"""
+        cursor = pooled_conn(self.db_path + '/toms.db')
+        philo_ids = list(philo_ids)
+        fetched = {}
+        for start in xrange(0, len(philo_ids), MAX_PARAMETERS):
+            chunk = philo_ids[start:start + MAX_PARAMETERS]
+            rows = dict((philo_id, {}) for philo_id in chunk)
+            cursor.execute('select * from toms where philo_id in (%s)' % ','.join('?' * len(chunk)), chunk)
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                row = dict(zip(columns, row))
+                rows[row['philo_id']] = row
+            for philo_id, row in rows.iteritems():
+                self.toms_rows[philo_id] = row
+            fetched.update(rows)
+        return fetched
         
     def get_obj_id(self, **metadata_info):
         return self.__get_info(**metadata_info)
@@ -55,46 +135,110 @@ class DocInfo(object):
         else:
             info = [hit['philo_id'] for hit in self.toms.query(**metadata_info)]
             if info == []:
-                conn = sqlite3.connect(self.db_path + '/toms.db')
-                c = conn.cursor()
-                c.execute('select head from toms')
-                headword_dict = dict([(headword[0].lower(), headword[0]) for headword in c.fetchall() if headword[0]  != None])
-                headword_list = [headword for headword in headword_dict]
-                close_matches = [headword_dict[word] for word in get_close_matches(metadata_info['head'], headword_list, 5)]
-                for match in close_matches:
-                    c.execute("SELECT philo_id FROM toms WHERE head = ?;",(match,))
-                    info.append(c.fetchone()[0])
+                close_matches = headword_index(self.db_path + '/').close_matches(metadata_info['head'], 5)
+                info = [philo_id for head, philo_id in close_matches]
         return info            
         
     def get_excerpt(self, doc_id, highlight=False):
         """Return a text excerpt by querying PhiloLogic and using 
         the byte offset to extract the passage"""
-        doc_id = doc_id.split()[0]
-        index = self.binary_search(doc_id)
-        if index:
-            offsets = self.hitlist.get_bytes(self.hitlist[index])
-            byte_offset = offsets[0]
-            conc_start = byte_offset - 200
-            if conc_start < 0:
-                conc_start = 0
-            text_path = self.db_path + "/TEXT/" + self.get_info(doc_id, 'filename')
-            text_file = open(text_path)
-            text_file.seek(conc_start)
-            text = text_file.read(400)
-            if highlight:
-                for word in self.patterns:
-                    text = word.sub('\\1<span style="color: red">\\2</span>\\3', text)
-            text = self.cut_begin.sub('', text)
-            text = self.cut_end.sub('', text)
-            text = text.replace('<s/>', '')
-            return text
-        else:
-            if self.query[self.word] != self.query[-1]:
-                self.word += 1
-            else:
-                self.word = 0
-            self.philo_search()
-            self.get_excerpt(doc_id)
+        return self.get_excerpts([doc_id], highlight)[0]
+
+    def get_excerpts(self, doc_ids, highlight=False):
+        """Return the excerpt of each document, or None for documents without hits.
+        Byte offsets come from the hit offsets recorded by the Indexer when there are some,
+        otherwise each query word is searched once. All the excerpts of a file are read
+        in one pass through its cached file handle."""
+        excerpts = [None] * len(doc_ids)
+        hits = []
+        for position, doc_id in enumerate(doc_ids):
+            byte_offset = self.recorded_offset(str(doc_id))
+            doc_id = str(doc_id).split()[0]
+            if byte_offset is None:
+                byte_offset = self.hit_offset(doc_id)
+            if byte_offset is not None:
+                hits.append((doc_id, byte_offset, position))
+        metadata = self.get_metadata_many(set(doc_id for doc_id, byte_offset, position in hits), ['filename'])
+        by_file = {}
+        for doc_id, byte_offset, position in hits:
+            by_file.setdefault(metadata[doc_id]['filename'], []).append((byte_offset, position))
+        for filename, offsets in by_file.iteritems():
+            text_file = self.text_file(filename)
+            for byte_offset, position in sorted(offsets):
+                text_file.seek(max(byte_offset - 200, 0))
+                excerpts[position] = self.format_excerpt(text_file.read(400), highlight)
+        return excerpts
+
+    def recorded_offset(self, obj_id):
+        """Lowest byte offset recorded by the Indexer for a query word in an object,
+        trying each query word in turn. Hits are taken from the object and the indexed
+        objects it contains, or else from its closest indexed ancestor."""
+        if not self.has_offsets:
+            return None
+        cursor = pooled_conn(self.offsets_file)
+        levels = obj_id.replace('-', ' ').split()
+        obj_id = ' '.join(levels)
+        words = self.offset_words[self.word:] + self.offset_words[:self.word]
+        condition = 'word in (%s)' % ','.join('?' * len(words))
+        offsets = {}
+        cursor.execute('select word, byte_offsets from hit_offsets where (obj_id = ? or obj_id between ? and ?) and '
+                       + condition, [obj_id, obj_id + ' ', obj_id + '!'] + words)
+        rows = cursor.fetchall()
+        while not rows and len(levels) > 1:
+            levels.pop()
+            cursor.execute('select word, byte_offsets from hit_offsets where obj_id = ? and ' + condition,
+                           [' '.join(levels)] + words)
+            rows = cursor.fetchall()
+        for word, byte_offsets in rows:
+            if byte_offsets:
+                offset = int(byte_offsets.split()[0])
+                offsets[word] = min(offset, offsets.get(word, offset))
+        for word in words:
+            if word in offsets:
+                return offsets[word]
+        return None
+
+    def indexed_words(self, words):
+        """Query words as the Indexer stored them in hit_offsets, stemmed if it used a stemmer"""
+        cursor = pooled_conn(self.offsets_file)
+        language = cursor.execute('select language from hit_offsets_stemmer').fetchone()[0]
+        if not language:
+            return list(words)
+        from vectorize import WordCounter, load_stemmer
+        stemmer = load_stemmer(language)
+        if not stemmer:
+            return list(words)
+        counter = WordCounter(None, 0, stemmer)
+        return [counter.stemm(word) for word in words]
+
+    def hit_offset(self, doc_id):
+        """Byte offset of the first hit of a document, trying each query word in turn"""
+        for word in self.query[self.word:] + self.query[:self.word]:
+            self.hitlist = self.word_hitlist(word)
+            index = self.binary_search(doc_id)
+            if index is not None:
+                return self.hitlist.get_bytes(self.hitlist[index])[0]
+        return None
+
+    def text_file(self, filename):
+        text_file = self.text_files.get(filename)
+        if text_file is None:
+            text_file = open(self.db_path + "/TEXT/" + filename)
+            self.text_files[filename] = text_file
+        return text_file
+
+    def format_excerpt(self, text, highlight=False):
+        if highlight:
+            for word in self.patterns:
+                text = word.sub('\\1<span style="color: red">\\2</span>\\3', text)
+        text = self.cut_begin.sub('', text)
+        text = self.cut_end.sub('', text)
+        text = text.replace('<s/>', '')
+        return text
+
+    def close(self):
+        """Close the cached text files"""
+        self.text_files.clear()
         
     def binary_search(self, doc_id, lo=0, hi=None):
         """Based on the Python bisect module"""
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import sqlite3
+import numpy as np
+from difflib import SequenceMatcher
+from os import path, remove, rename
+from corpus_stats import save_npz
+
+## Headwords sharing the most trigrams with a query are scored with difflib
+CANDIDATES = 50
+
+loaded_indexes = {}
+
+
+def trigrams(word):
+    word = ' %s ' % word.lower()
+    return set(word[i:i + 3] for i in xrange(len(word) - 2))
+
+
+class HeadwordIndex(object):
+    """Approximate lookup of the heads of toms.db, scored like difflib.get_close_matches
+    over all lowercased heads. Only the heads sharing the most character trigrams with
+    the query are scored, using trigram postings stored in headword_index.npz."""
+
+    def __init__(self, keys, heads, philo_ids, grams, indptr, postings, toms_mtime):
+        self.keys = keys
+        self.heads = heads
+        self.philo_ids = philo_ids
+        self.grams = grams
+        self.indptr = indptr
+        self.postings = postings
+        self.toms_mtime = toms_mtime
+        self.gram_index = dict((gram, row) for row, gram in enumerate(grams))
+        self.gram_counts = np.bincount(postings, minlength=len(keys))
+
+    @classmethod
+    def build(cls, db_path):
+        """Read every head of toms.db. As in DocInfo, the original head of a lowercased
+        head is the last one seen, and its philo_id the first with that head."""
+        conn = sqlite3.connect(db_path + 'toms.db')
+        conn.text_factory = str
+        c = conn.cursor()
+        originals = {}
+        first_ids = {}
+        for head, philo_id in c.execute('select head, philo_id from toms where head is not null'):
+            originals[head.lower()] = head
+            first_ids.setdefault(head, philo_id)
+        c.close()
+        conn.close()
+        keys = sorted(originals)
+        heads = [originals[key] for key in keys]
+        postings = {}
+        for row, key in enumerate(keys):
+            for gram in trigrams(key):
+                postings.setdefault(gram, []).append(row)
+        grams = sorted(postings)
+        indptr = np.cumsum([0] + [len(postings[gram]) for gram in grams]).astype(np.int64)
+        rows = [row for gram in grams for row in postings[gram]]
+        return cls(keys, heads, [first_ids[head] for head in heads], grams, indptr,
+                   np.array(rows, dtype=np.int32), path.getmtime(db_path + 'toms.db'))
+
+    def save(self, db_path):
+        """Write the index next to toms.db, replacing any previous one at once"""
+        temp_file = db_path + 'headword_index.tmp.npz'
+        save_npz(temp_file, keys=np.array(self.keys, dtype=str),
+                 heads=np.array(self.heads, dtype=str), philo_ids=np.array(self.philo_ids, dtype=str),
+                 grams=np.array(self.grams, dtype=str), indptr=self.indptr, postings=self.postings,
+                 toms_mtime=np.array([self.toms_mtime]))
+        rename(temp_file, db_path + 'headword_index.npz')
+
+    @classmethod
+    def load(cls, db_path):
+        index = np.load(db_path + 'headword_index.npz')
+        return cls(index['keys'].tolist(), index['heads'].tolist(), index['philo_ids'].tolist(),
+                   index['grams'].tolist(), index['indptr'], index['postings'], float(index['toms_mtime'][0]))
+
+    def close_matches(self, word, n=5, cutoff=0.6):
+        """Return the (head, philo_id) of the n best matches of word"""
+        rows = [self.gram_index[gram] for gram in trigrams(word) if gram in self.gram_index]
+        if not rows:
+            return []
+        hits = np.concatenate([self.postings[self.indptr[row]:self.indptr[row + 1]] for row in rows])
+        counts = np.bincount(hits, minlength=len(self.keys))
+        candidates = np.flatnonzero(counts)
+        if len(candidates) > CANDIDATES:
+            ## Dice coefficient of the trigram sets, which follows the difflib ratio
+            dice = counts[candidates] / (self.gram_counts[candidates] + len(rows))
+            best = np.argpartition(-dice, CANDIDATES - 1)[:CANDIDATES]
+            candidates = candidates[best]
+        matcher = SequenceMatcher()
+        matcher.set_seq2(word)
+        scored = []
+        for row in candidates:
+            matcher.set_seq1(self.keys[row])
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                score = matcher.ratio()
+                if score >= cutoff:
+                    scored.append((score, self.keys[row], row))
+        scored.sort(reverse=True)
+        return [(self.heads[row], self.philo_ids[row]) for score, key, row in scored[:n]]
+
+
+def build_headword_index(db_path):
+    """Build and store the headword index of a database, as the Indexer does"""
+    index = HeadwordIndex.build(db_path)
+    index.save(db_path)
+    return index
+
+def headword_index(db_path):
+    """Return the headword index stored next to toms.db by the Indexer. When it is
+    missing or older than toms.db, it is rebuilt and stored if the directory is
+    writable, and otherwise kept in memory only."""
+    toms_mtime = path.getmtime(db_path + 'toms.db')
+    if db_path in loaded_indexes and loaded_indexes[db_path].toms_mtime == toms_mtime:
+        return loaded_indexes[db_path]
+    index = None
+    if path.isfile(db_path + 'headword_index.npz'):
+        index = HeadwordIndex.load(db_path)
+    if index is None or index.toms_mtime != toms_mtime:
+        index = HeadwordIndex.build(db_path)
+        try:
+            index.save(db_path)
+        except (IOError, OSError):
+            if path.isfile(db_path + 'headword_index.tmp.npz'):
+                remove(db_path + 'headword_index.tmp.npz')
+    loaded_indexes[db_path] = index
+    return index
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import threading
+
+## Instrumentation is enabled wherever no instrument is given by setting PHILO_INSTRUMENT:
+##   PHILO_INSTRUMENT=log              each record is printed on stderr
+##   PHILO_INSTRUMENT=/tmp/stats.json  each record is appended to the file as one line of JSON
+## Records are dicts holding the operation name, its context (db, query...), the time it
+## was emitted, the timers in seconds and the counters. Timers may nest: total holds the others.
+INSTRUMENT_VARIABLE = 'PHILO_INSTRUMENT'
+
+env_sinks = {}
+
+
+class Instrument(object):
+    """Named timers and counters of an operation, sent to sink as one record by emit.
+    sink is any callable taking the record: log_sink, a JSONSink or a callback.
+
+    instrument = Instrument(JSONSink('/tmp/search.json'))
+    with instrument.timer('get_hits'):
+        hits = get_hits(word)
+    instrument.count('postings', len(hits))
+    instrument.emit('search', db=db)"""
+
+    enabled = True
+
+    def __init__(self, sink=None):
+        self.sink = sink or log_sink
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name):
+        """Context manager adding the time spent in its block to timer name"""
+        return Timer(self, name)
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def iterate(self, name, iterable):
+        """Iterate over iterable, adding the time spent producing each item to timer name"""
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.time() - started)
+                return
+            self.add_time(name, time.time() - started)
+            yield item
+
+    def emit(self, operation, **context):
+        """Send the timers and counters gathered since the last record, then reset them"""
+        record = dict(context)
+        record.update({'operation': operation, 'time': time.time(),
+                       'timers': self.timers, 'counters': self.counters})
+        self.timers = {}
+        self.counters = {}
+        self.sink(record)
+
+
+class Timer(object):
+
+    def __init__(self, instrument, name):
+        self.instrument = instrument
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrument.add_time(self.name, time.time() - self.started)
+
+
+class NullInstrument(object):
+    """Instrument used when instrumentation is off: every call does nothing"""
+
+    enabled = False
+
+    def timer(self, name):
+        return NULL_TIMER
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def emit(self, operation, **context):
+        pass
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+NULL_INSTRUMENT = NullInstrument()
+
+
+def to_json(value):
+    """Convert numpy values left in records"""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+def log_sink(record):
+    """Print a record on one line of stderr"""
+    print >> sys.stderr, json.dumps(record, sort_keys=True, default=to_json)
+
+
+class JSONSink(object):
+    """Append each record to a file as one line of JSON.
+    The file is opened for each record, so that forked processes can share the sink."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True, default=to_json) + '\n'
+        with self.lock:
+            output = open(self.path, 'a')
+            output.write(line)
+            output.close()
+
+
+def get_instrument(instrument=None):
+    """Instrument for an operation, from the instrument argument of its class:
+    an Instrument is used as is, a callable becomes the sink of a new Instrument,
+    True uses log_sink and False turns instrumentation off.
+    With None, PHILO_INSTRUMENT decides."""
+    if instrument is None:
+        setting = os.environ.get(INSTRUMENT_VARIABLE, '')
+        if setting in ('', '0'):
+            return NULL_INSTRUMENT
+        if setting not in env_sinks:
+            if setting in ('1', 'log'):
+                env_sinks[setting] = log_sink
+            else:
+                env_sinks[setting] = JSONSink(setting)
+        return Instrument(env_sinks[setting])
+    if instrument is True:
+        return Instrument()
+    if instrument is False:
+        return NULL_INSTRUMENT
+    if isinstance(instrument, (Instrument, NullInstrument)):
+        return instrument
+    return Instrument(instrument)
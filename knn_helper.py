@@ -1,30 +1,105 @@
 #!/usr/bin/env python
 
+import numpy as np
 from operator import itemgetter
+from os import path as os_path
 from data_handler import *
 from word_mapper import mapper
+from neighbor_store import NeighborStore, has_neighbor_store, neighbor_store_path
 
+## SQLite refuses statements with more than 999 parameters
+MAX_PARAMETERS = 999
 
 
 class knn(object):
     
-    def __init__(self, db, path='/var/lib/philologic/databases/', measure='cosine', db_name=False):
+    def __init__(self, db, path='/var/lib/philologic/databases/', measure='cosine', db_name=False, cache_size=10000):
         if db_name:
             db_name = path + db + '/' + db_name
         else:
             db_name = path + db + '/' + measure + '_distance_results.sqlite'
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        
+        self.db_name = db_name
+        self.store_path = neighbor_store_path(db_name)
+        self.cache = LRUCache(cache_size)
+        self.mtime = None
+        self.store = None
+        self.__connect()
+
+    def __connect(self):
+        """Check the results, emptying the cache if they changed on disk.
+        A neighbor store written by KNN_stored is used instead of the database when present."""
+        if has_neighbor_store(self.store_path):
+            mtime = os_path.getmtime(self.store_path + 'meta.json')
+            if mtime != self.mtime or self.store is None:
+                self.store = NeighborStore(self.store_path)
+                self.cache.clear()
+                self.mtime = mtime
+            return
+        ## the connection itself is opened once per thread by pooled_conn
+        self.store = None
+        mtime = file_mtime(self.db_name)
+        if mtime != self.mtime:
+            self.cache.clear()
+            self.mtime = mtime
             
     def search(self, obj_id, display=10):
-        level = len(obj_id.split())
-        while level:
-            obj_id = ' '.join(obj_id.split()[:level])
-            query = """select neighbor_obj_id, neighbor_distance from obj_results where obj_id = '%s' order by neighbor_distance desc limit %d""" % (obj_id, display)
-            self.cursor.execute(query)
-            results = self.cursor.fetchall()
-            if results != []:
-                return results
-            level -= 1
-        return []
\ No newline at end of file
+        return self.search_many([obj_id], display)[obj_id]
+
+    def search_many(self, obj_ids, display=10):
+        """Return a dict of the display closest neighbors of each obj_id.
+        An obj_id without results falls back on its closest ancestor with results."""
+        self.__connect()
+        neighbors = {}
+        pending = {}
+        for obj_id in obj_ids:
+            cached = self.cache.get((obj_id, display))
+            if cached is not None:
+                neighbors[obj_id] = list(cached)
+            else:
+                pending[obj_id] = obj_id.split()
+        ## All ids still without results are looked up at once, one level up each time
+        while pending:
+            lookups = set(' '.join(levels) for levels in pending.itervalues())
+            results = self.__neighbors(lookups, display)
+            for obj_id, levels in pending.items():
+                lookup = ' '.join(levels)
+                if lookup in results or len(levels) <= 1:
+                    ## the cache keeps tuples, callers get their own lists
+                    cached = tuple(results.get(lookup, []))
+                    self.cache[(obj_id, display)] = cached
+                    neighbors[obj_id] = list(cached)
+                    del pending[obj_id]
+                else:
+                    levels.pop()
+        return neighbors
+
+    def arrays(self, obj_id, display=10):
+        """Return the rows and scores of the neighbors of an object as views of
+        the neighbor store, along with the obj_ids of the rows"""
+        self.__connect()
+        if self.store is None:
+            raise ValueError('no neighbor store in %s, use search_many' % self.store_path)
+        levels = obj_id.split()
+        while len(levels) > 1 and ' '.join(levels) not in self.store:
+            levels.pop()
+        obj_id = ' '.join(levels)
+        if obj_id not in self.store:
+            return (np.empty(0, dtype=self.store.neighbors.dtype), np.empty(0, dtype=self.store.scores.dtype),
+                    self.store.obj_ids)
+        neighbors, scores = self.store.arrays(obj_id, display)
+        return neighbors, scores, self.store.obj_ids
+
+    def __neighbors(self, obj_ids, display):
+        if self.store is not None:
+            return dict((obj_id, self.store.results(obj_id, display)) for obj_id in obj_ids if obj_id in self.store)
+        obj_ids = list(obj_ids)
+        cursor = pooled_conn(self.db_name)
+        results = {}
+        for start in xrange(0, len(obj_ids), MAX_PARAMETERS):
+            chunk = obj_ids[start:start + MAX_PARAMETERS]
+            query = """select obj_id, neighbor_obj_id, neighbor_distance from obj_results where obj_id in (%s) order by obj_id, neighbor_distance desc""" % ','.join('?' * len(chunk))
+            for obj_id, neighbor, distance in cursor.execute(query, chunk):
+                obj_results = results.setdefault(obj_id, [])
+                if len(obj_results) < display:
+                    obj_results.append((neighbor, distance))
+        return results
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import json
+import sqlite3
+import numpy as np
+from os import makedirs, path
+from data_handler import load_arrays, obj_arrays_path
+
+
+class LSHIndex(object):
+    """Approximate nearest neighbor index over the object arrays of a database,
+    based on random hyperplane projections (cosine similarity).
+
+    Each of the tables hashes a vector to a bits-long signature. Objects sharing a
+    signature in any table are candidates, which are then ranked by their exact
+    cosine similarity. More tables and fewer bits raise recall at the cost of
+    larger candidate sets; probes additionally visits the buckets obtained by
+    flipping the bits closest to their hyperplane."""
+
+    def __init__(self, db, path='/var/lib/philologic/databases/', index_dir='lsh_index/'):
+        self.db_path = path + db + '/'
+        self.index_path = self.db_path + index_dir
+        self.arrays_path = obj_arrays_path(self.db_path)
+        self.loaded = False
+
+    def build(self, tables=8, bits=16, seed=0):
+        """Hash every object array and save the index next to the database"""
+        if bits > 64:
+            raise ValueError('bits must be 64 or lower')
+        self.objects, self.matrix = load_arrays(self.arrays_path, normalize=False)
+        self.row_index = dict((obj_id, row) for row, obj_id in enumerate(self.objects))
+        rows, dim = self.matrix.shape
+        self.tables, self.bits = tables, bits
+        self.planes = np.random.RandomState(seed).randn(dim, tables * bits).astype(np.float32)
+        self.norms = self.row_norms(self.matrix)
+        self.codes = np.empty((tables, rows), dtype=np.uint64)
+        self.order = np.empty((tables, rows), dtype=np.int32)
+        for start in xrange(0, rows, 4096):
+            block = slice(start, min(start + 4096, rows))
+            signatures = self.signatures(self.project(self.matrix[block]))
+            self.codes[:, block] = signatures.T
+        for table in xrange(tables):
+            self.order[table] = np.argsort(self.codes[table], kind='mergesort')
+            self.codes[table] = self.codes[table][self.order[table]]
+        self.save(seed)
+        self.loaded = True
+
+    def save(self, seed):
+        if not path.isdir(self.index_path):
+            makedirs(self.index_path, 0755)
+        np.save(self.index_path + 'planes.npy', self.planes)
+        np.save(self.index_path + 'codes.npy', self.codes)
+        np.save(self.index_path + 'order.npy', self.order)
+        np.save(self.index_path + 'norms.npy', self.norms)
+        output = open(self.index_path + 'meta.json', 'w')
+        json.dump({'tables': self.tables, 'bits': self.bits, 'seed': seed, 'arrays': self.arrays_path}, output)
+        output.close()
+
+    def load(self):
+        """Memory-map a saved index along with the object arrays it was built from"""
+        meta = json.load(open(self.index_path + 'meta.json'))
+        self.tables, self.bits = meta['tables'], meta['bits']
+        self.arrays_path = meta['arrays']
+        self.planes = np.load(self.index_path + 'planes.npy', mmap_mode='r')
+        self.codes = np.load(self.index_path + 'codes.npy', mmap_mode='r')
+        self.order = np.load(self.index_path + 'order.npy', mmap_mode='r')
+        self.norms = np.load(self.index_path + 'norms.npy', mmap_mode='r')
+        self.objects, self.matrix = load_arrays(self.arrays_path, normalize=False)
+        self.row_index = dict((obj_id, row) for row, obj_id in enumerate(self.objects))
+        self.loaded = True
+
+    def row_norms(self, matrix):
+        if hasattr(matrix, 'multiply'):
+            return np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        return np.sqrt(np.einsum('ij,ij->i', matrix, matrix, dtype=np.float64))
+
+    def project(self, vectors):
+        projection = vectors.dot(self.planes)
+        return np.asarray(projection).reshape(-1, self.tables, self.bits)
+
+    def signatures(self, projection):
+        """Turn projections of shape (vectors, tables, bits) into one code per table"""
+        weights = np.uint64(1) << np.arange(self.bits, dtype=np.uint64)
+        return ((projection > 0).astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+
+    def probe_codes(self, projection, probes):
+        """Codes of the buckets to visit in each table: the query's own bucket,
+        then the ones reached by flipping each of the probes least certain bits"""
+        codes = self.signatures(projection[None])[0]
+        probe_codes = [codes]
+        closest = np.argsort(np.abs(projection), axis=1)[:, :probes]
+        for probe in xrange(closest.shape[1]):
+            flips = np.uint64(1) << closest[:, probe].astype(np.uint64)
+            probe_codes.append(codes ^ flips)
+        return np.vstack(probe_codes).T
+
+    def candidates(self, vector, probes=0):
+        projection = self.project(vector.reshape(1, -1))[0]
+        found = []
+        for table, codes in enumerate(self.probe_codes(projection, probes)):
+            starts = np.searchsorted(self.codes[table], codes, side='left')
+            ends = np.searchsorted(self.codes[table], codes, side='right')
+            for start, end in zip(starts, ends):
+                found.append(self.order[table][start:end])
+        if not found:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate(found))
+
+    def search(self, query, display=10, probes=0):
+        """Return the display nearest objects of a vector or an obj_id
+        as a list of (neighbor_obj_id, similarity), like knn.search"""
+        if not self.loaded:
+            self.load()
+        exclude = None
+        if isinstance(query, basestring):
+            exclude = self.row_index[query.replace('-', ' ')]
+            vector = self.matrix[exclude]
+            if hasattr(vector, 'toarray'):
+                vector = vector.toarray()
+            vector = np.asarray(vector, dtype=np.float64).ravel()
+        else:
+            vector = np.asarray(query, dtype=np.float64).ravel()
+        rows = self.candidates(vector, probes)
+        if exclude is not None:
+            rows = rows[rows != exclude]
+        if not len(rows):
+            return []
+        scores = np.asarray(self.matrix[rows].dot(vector)).ravel()
+        norm = np.sqrt(vector.dot(vector))
+        scores = np.nan_to_num(scores / (self.norms[rows] * norm))
+        if len(rows) > display:
+            best = np.argpartition(-scores, display - 1)[:display]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.lexsort((rows[best], -scores[best]))]
+        return [(self.objects[rows[i]], float(scores[i])) for i in best]
+
+    def recall(self, results_file, display=10, probes=0, sample=100, seed=0):
+        """Average fraction of the exact neighbors stored by KNN_stored in results_file
+        (a cosine obj_results table) that the index returns for a sample of objects"""
+        if not self.loaded:
+            self.load()
+        conn = sqlite3.connect(results_file)
+        conn.text_factory = str
+        cursor = conn.cursor()
+        objects = list(self.objects)
+        np.random.RandomState(seed).shuffle(objects)
+        total, measured = 0.0, 0
+        for obj_id in objects[:sample]:
+            cursor.execute('select neighbor_obj_id from obj_results where obj_id=? order by neighbor_distance desc limit ?', (obj_id, display))
+            exact = set(row[0] for row in cursor.fetchall())
+            if not exact:
+                continue
+            found = set(neighbor for neighbor, score in self.search(obj_id, display, probes))
+            total += len(exact & found) / len(exact)
+            measured += 1
+        cursor.close()
+        if not measured:
+            return 0.0
+        return total / measured
@@ -5,11 +5,11 @@ import sys
 import os
 import gzip
 import re
-import sqlite3
-import json
 from subprocess import call
 from operator import itemgetter
-from numpy import zeros, float32, save
+from collections import Counter
+from numpy import zeros, float32, save, load, vstack, array
+from bulk_writer import BulkWriter
 
 
 class Mallet(object):
@@ -41,68 +41,44 @@ class Mallet(object):
         call(command, shell=True) 
 
     def parse_topics(self, word_limit=100):
+        """Count the words assigned to each topic in the sampling state and store
+        them in topic_words, one row per topic and word, ranked by weight"""
         output_file = self.db_path + '/topic_model/output_state.gz'
-        topics = {}
-        start = 0
+        counts = Counter()
+        ## the header ends with the #beta line
         for line in gzip.open(output_file):
-            if re.search('#beta', line):
-                start = 1
-                continue
-            if not start:
+            if line.startswith('#'):
                 continue
             fields = line.split()
-            word = fields[4]
-            topic = fields[5]
-            if topic not in topics:
-                topics[topic] = {}
-            if word not in topics[topic]:
-                topics[topic][word] = 1
-            else:
-                topics[topic][word] += 1
-        ordered_topics = {}
-        positions = {}
-        words_in_topic = {}
-        for topic in topics:
-            if topic not in ordered_topics:
-                ordered_topics[topic] = {}
-            for pos, word in enumerate(sorted(topics[topic], key=topics[topic].get, reverse=True)):
-                ordered_topics[topic][word] = pos
-                if word not in positions:
-                    positions[word] = []
-                positions[word].append((topic, pos))
-                if topic not in words_in_topic:
-                    words_in_topic[topic] = 0
-                words_in_topic[topic] += topics[topic][word]
-                
-        conn = sqlite3.connect(self.db_path + '/lda_topics.sqlite')
-        conn.text_factory = str
-        c = conn.cursor()
-        
-        ## store topics in database
-        c.execute('''create table topics (topic int, words text)''')
-        c.execute('''create index topic_index on topics(topic)''')
-        for topic in topics:
-            words_freq = dict([(word, (topics[topic][word] / words_in_topic[topic])) for word in topics[topic]])
-            c.execute('insert into topics values (?,?)', (topic, json.dumps(words_freq)))
-        conn.commit()
+            counts[(int(fields[5]), fields[4])] += 1
+        words_in_topic = Counter()
+        for (topic, word), count in counts.iteritems():
+            words_in_topic[topic] += count
+        ranked = sorted(counts.iteritems(), key=lambda item: (item[0][0], -item[1], item[0][1]))
         
-        ## Store highest topic for each word in database
-        c.execute('''create table word_position (word text, topic int, position int)''')
-        c.execute('''create index word_index on word_position(word)''')
-        for word in positions:
-            for topic, pos in positions[word]:
-                c.execute('insert into word_position values (?,?,?)', (word, topic, pos))
-        conn.commit()
-        c.close()
+        writer = BulkWriter(self.db_path + '/lda_topics.sqlite')
+        writer.execute('''create table topic_words (topic int, word text, weight real, rank int)''')
+        writer.create_index('''create index topic_rank_index on topic_words(topic, rank)''')
+        writer.create_index('''create index topic_word_index on topic_words(word)''')
+        rank = 0
+        previous_topic = None
+        for (topic, word), count in ranked:
+            if topic != previous_topic:
+                rank = 0
+                previous_topic = topic
+            writer.insert('topic_words', (topic, word, count / words_in_topic[topic], rank))
+            rank += 1
+        writer.close()
             
                 
     def parse_topics_in_docs(self):
+        """Store the topic proportions of each document in topic_model/doc_topics.npy,
+        a (documents x topics) matrix whose row obj_ids are in doc_topics.txt"""
         input_file = self.db_path + '/topic_model/output_doc_topics'
-        array_path = self.db_path + '/topic_model/topic_arrays/'
-        os.makedirs(array_path)
         path = re.compile('file:' + self.db_path + '/pruned_texts/')
         extension = re.compile('\.txt')
-        topic_prop = {}
+        docs = []
+        arrays = []
         for line in open(input_file):
             if re.search('#', line):
                 continue
@@ -111,16 +87,31 @@ class Mallet(object):
             doc = fields.pop(0)
             doc = path.sub('', doc)
             doc = extension.sub('', doc)
-            array_location = array_path + doc + '.npy'
-            doc = doc.replace('-', ' ')
-            topic_prop[doc] = []
+            docs.append(doc.replace('-', ' '))
             for pos, field in enumerate(fields):
                 if self.isodd(pos):
                     continue
                 topic = int(fields[pos])
                 proportion = float(fields[pos + 1])
                 array[topic] = proportion
-            save(array_location, array)
+            arrays.append(array)
+        matrix = vstack(arrays) if arrays else zeros((0, self.topics), dtype=float32)
+        save(self.db_path + '/topic_model/doc_topics.npy', matrix)
+        output = open(self.db_path + '/topic_model/doc_topics.txt', 'w')
+        for doc in docs:
+            output.write(doc + '\n')
+        output.close()
+
+    def export_topic_arrays(self):
+        """Write the rows of doc_topics.npy as one array per document in
+        topic_model/topic_arrays/, the layout used before doc_topics.npy"""
+        array_path = self.db_path + '/topic_model/topic_arrays/'
+        if not os.path.isdir(array_path):
+            os.makedirs(array_path)
+        docs = [line.rstrip('\n') for line in open(self.db_path + '/topic_model/doc_topics.txt')]
+        matrix = load(self.db_path + '/topic_model/doc_topics.npy', mmap_mode='r')
+        for row, doc in enumerate(docs):
+            save(array_path + doc.replace(' ', '-') + '.npy', array(matrix[row]))
         
     def isodd(self, num):
         """Function taken from http://stackoverflow.com/questions/1089936/even-and-odd-number"""
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+from os import makedirs, path
+
+
+## The neighbors of N objects are stored in their own directory as raw
+## little-endian arrays which are memory-mapped when loaded:
+##   neighbors.bin  int32 (N, k) row of each neighbor, best first, -1 when there are fewer than k
+##   scores.bin     float32 (N, k) similarity of each neighbor
+##   obj_ids.txt    the obj_id of each row, one per line
+##   meta.json      shape and dtypes, written last
+NEIGHBOR_TYPE = np.dtype('<i4')
+SCORE_TYPE = np.dtype('<f4')
+
+
+def neighbor_store_path(db_file):
+    """Directory of the neighbor store used instead of a results database"""
+    return db_file.replace('.sqlite', '') + '/'
+
+
+class NeighborWriter(object):
+    """Writes the neighbors of each object, in any order of rows"""
+
+    def __init__(self, store_path, obj_ids, k):
+        self.path = store_path
+        if not path.isdir(self.path):
+            makedirs(self.path, 0755)
+        self.shape = (len(obj_ids), k)
+        output = open(self.path + 'obj_ids.txt', 'w')
+        for obj_id in obj_ids:
+            output.write(obj_id + '\n')
+        output.close()
+        self.neighbors = self.__map('neighbors.bin', NEIGHBOR_TYPE)
+        self.scores = self.__map('scores.bin', SCORE_TYPE)
+        self.neighbors[:] = -1
+        self.scores[:] = -np.inf
+
+    def __map(self, name, dtype):
+        if not self.shape[0] * self.shape[1]:
+            open(self.path + name, 'wb').close()
+            return np.zeros(self.shape, dtype=dtype)
+        return np.memmap(self.path + name, dtype=dtype, mode='w+', shape=self.shape)
+
+    def add(self, rows, neighbors, scores):
+        """Store the neighbors of the rows slice, as yielded by Similarity.top_k"""
+        k = neighbors.shape[1]
+        self.neighbors[rows, :k] = neighbors
+        self.scores[rows, :k] = scores
+
+    def close(self):
+        for array in (self.neighbors, self.scores):
+            if isinstance(array, np.memmap):
+                array.flush()
+        meta = {'shape': list(self.shape), 'neighbors': NEIGHBOR_TYPE.str, 'scores': SCORE_TYPE.str}
+        output = open(self.path + 'meta.json', 'w')
+        json.dump(meta, output)
+        output.close()
+        print '%d neighbor lists stored in %s' % (self.shape[0], self.path)
+
+
+class NeighborStore(object):
+    """Memory-mapped neighbor lists, addressable by obj_id"""
+
+    def __init__(self, store_path):
+        self.path = store_path
+        meta = json.load(open(self.path + 'meta.json'))
+        self.shape = tuple(meta['shape'])
+        self.neighbors = self.__map('neighbors.bin', meta['neighbors'])
+        self.scores = self.__map('scores.bin', meta['scores'])
+        self.obj_ids = [line.rstrip('\n') for line in open(self.path + 'obj_ids.txt')]
+        self.row_index = dict((obj_id, row) for row, obj_id in enumerate(self.obj_ids))
+
+    def __map(self, name, dtype):
+        if not self.shape[0] * self.shape[1]:
+            return np.zeros(self.shape, dtype=dtype)
+        return np.memmap(self.path + name, dtype=dtype, mode='r', shape=self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __contains__(self, obj_id):
+        return obj_id in self.row_index
+
+    def arrays(self, obj_id, display=10):
+        """Return the rows and scores of the display closest neighbors of an object
+        as views of the memory-mapped arrays"""
+        row = self.row_index[obj_id]
+        neighbors = self.neighbors[row, :display]
+        count = len(neighbors) - np.count_nonzero(neighbors < 0)
+        return neighbors[:count], self.scores[row, :count]
+
+    def results(self, obj_id, display=10):
+        """Same as arrays, as a list of (neighbor_obj_id, score)"""
+        neighbors, scores = self.arrays(obj_id, display)
+        return [(self.obj_ids[neighbor], float(score)) for neighbor, score in zip(neighbors, scores)]
+
+
+def has_neighbor_store(store_path):
+    return path.isfile(store_path + 'meta.json')
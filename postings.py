@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import json
+import numpy as np
+from os import makedirs, path, remove
+
+## Postings are stored in a directory:
+##   postings.bin  for each word, blocks of block_size postings, each block holding
+##                 the varint-encoded doc number deltas followed by the varint frequencies
+##   words.txt     one word per line, in word id order
+##   terms.npy     per word: byte offset, number of postings, index of its first block
+##   blocks.npy    per block: last doc number, byte offset
+##   block_max.npy per block: highest frequency, frequency / length and BM25 term frequency part
+##   term_max.npy  per word: the same maxima over all its postings, used as score upper bounds
+##   docs.txt      obj_id of each doc number
+##   lengths.npy   length in words of each doc number
+##   meta.json     depth, block size, counts and the average length used for the BM25 maxima
+## Doc numbers are assigned in indexing order, so each postings list is sorted by doc number.
+
+postings_cache = {}
+
+## BM25 parameters used for the stored upper bounds, the defaults of Searcher.bm25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def varint_encode(values):
+    """Encode an array of non-negative integers as LEB128 varints"""
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint8)
+    sizes = np.ones(len(values), dtype=np.int64)
+    remaining = values >> np.uint64(7)
+    while remaining.any():
+        sizes += remaining > 0
+        remaining >>= np.uint64(7)
+    starts = np.cumsum(sizes) - sizes
+    output = np.empty(sizes.sum(), dtype=np.uint8)
+    for byte in xrange(sizes.max()):
+        present = sizes > byte
+        chunk = (values[present] >> np.uint64(7 * byte)) & np.uint64(0x7f)
+        more = (sizes[present] > byte + 1).astype(np.uint64) << np.uint64(7)
+        output[starts[present] + byte] = chunk | more
+    return output
+
+def varint_decode(data):
+    """Decode a byte array of LEB128 varints"""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    chunks = (data & 0x7f).astype(np.int64) << (7 * position)
+    return np.add.reduceat(chunks, starts)
+
+def bm25_part(freqs, lengths, avg_length, k1=BM25_K1, b=BM25_B):
+    """The BM25 score of a posting without its IDF factor"""
+    freqs = freqs.astype(np.float64)
+    return (freqs * (k1 + 1.0)) / (freqs + k1 * ((1.0 - b) + b * np.floor(lengths / avg_length)))
+
+def has_postings(postings_path):
+    return path.isfile(postings_path + 'meta.json')
+
+def load_postings(postings_path):
+    """Open the postings in postings_path once per process,
+    and again when the Indexer writes new ones"""
+    mtime = path.getmtime(postings_path + 'meta.json')
+    if postings_path not in postings_cache or postings_cache[postings_path][0] != mtime:
+        postings_cache[postings_path] = (mtime, PostingsReader(postings_path))
+    return postings_cache[postings_path][1]
+
+def run_words(run_file, chunk_rows=64 * 1024):
+    """Yield the word id and hits of each word of a run, in word id order.
+    Word ids are read chunk_rows at a time, so that merging keeps one chunk per run in memory."""
+    hits = np.memmap(run_file, dtype=np.int32, mode='r').reshape(-1, 3)
+    column = np.zeros(0, dtype=np.int32)
+    column_start = 0
+    start = 0
+    while start < len(hits):
+        if start - column_start >= len(column):
+            column = np.array(hits[start:start + chunk_rows, 0])
+            column_start = start
+        word_id = column[start - column_start]
+        end = column_start + np.searchsorted(column, word_id, side='right')
+        ## the word goes on in the next chunks
+        while end == column_start + len(column) and end < len(hits):
+            column = np.array(hits[end:end + chunk_rows, 0])
+            column_start = end
+            end = column_start + np.searchsorted(column, word_id, side='right')
+        yield int(word_id), hits[start:end]
+        start = end
+
+
+class PostingsWriter(object):
+    """Collects the word counts of each indexed object and writes
+    the packed postings of every word.
+    Hits are buffered in memory up to buffer_size bytes, then sorted by word
+    and spilled to a run file. Runs are merged word by word when closing."""
+
+    def __init__(self, postings_path, word_map, depth=0, block_size=128, buffer_size=512 * 1024 * 1024):
+        self.path = postings_path
+        if not path.isdir(self.path):
+            makedirs(self.path, 0755)
+        self.word_map = word_map
+        self.depth = depth
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.doc_ids = []
+        self.lengths = []
+        self.buffer = []
+        self.buffered = 0
+        self.runs = []
+
+    def add_document(self, obj_id, length, word_freqs):
+        """Record the words of an object given a list of (word, frequency)"""
+        doc = len(self.doc_ids)
+        self.doc_ids.append(obj_id)
+        self.lengths.append(length)
+        hits = np.empty((len(word_freqs), 3), dtype=np.int32)
+        hits[:, 0] = [self.word_map[word] for word, freq in word_freqs]
+        hits[:, 1] = doc
+        hits[:, 2] = [freq for word, freq in word_freqs]
+        self.buffer.append(hits)
+        self.buffered += hits.nbytes
+        if self.buffered >= self.buffer_size:
+            self.spill()
+
+    def spill(self):
+        """Sort the buffered hits by word, keeping doc order, and write them as a run"""
+        if not self.buffer:
+            return
+        hits = np.concatenate(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if not len(hits):
+            return
+        hits = hits[np.argsort(hits[:, 0], kind='mergesort')]
+        run_file = self.path + 'run%d.tmp' % len(self.runs)
+        hits.tofile(run_file)
+        self.runs.append(run_file)
+
+    def merged_hits(self, word_count):
+        """Yield the doc numbers and frequencies of each word id, gathered from every run"""
+        runs = [run_words(run_file) for run_file in self.runs]
+        heads = [next(run, None) for run in runs]
+        for word_id in xrange(word_count):
+            slices = []
+            for i, head in enumerate(heads):
+                if head is not None and head[0] == word_id:
+                    slices.append(head[1])
+                    heads[i] = next(runs[i], None)
+            if slices:
+                word_hits = np.concatenate(slices)
+            else:
+                word_hits = np.zeros((0, 3), dtype=np.int32)
+            yield word_id, word_hits[:, 1], word_hits[:, 2]
+
+    def close(self):
+        self.spill()
+        words = sorted(self.word_map, key=self.word_map.get)
+        terms = np.zeros((len(words), 3), dtype=np.int64)
+        blocks = []
+        block_max = []
+        lengths = np.array(self.lengths, dtype=np.int64)
+        if len(self.lengths):
+            avg_length = float(sum(self.lengths) / len(self.lengths))
+        else:
+            avg_length = 1.0
+        output = open(self.path + 'postings.bin', 'wb')
+        offset = 0
+        for word_id, docs, freqs in self.merged_hits(len(words)):
+            terms[word_id] = (offset, len(docs), len(blocks))
+            previous = 0
+            for block_start in xrange(0, len(docs), self.block_size):
+                block_docs = docs[block_start:block_start + self.block_size].astype(np.int64)
+                block_freqs = freqs[block_start:block_start + self.block_size]
+                deltas = np.empty_like(block_docs)
+                deltas[0] = block_docs[0] - previous
+                deltas[1:] = np.diff(block_docs)
+                encoded = varint_encode(np.concatenate((deltas, block_freqs)))
+                blocks.append((block_docs[-1], offset))
+                block_lengths = lengths[block_docs].astype(np.float64)
+                block_max.append((block_freqs.max(), (block_freqs / block_lengths).max(),
+                                  bm25_part(block_freqs, block_lengths, avg_length).max()))
+                encoded.tofile(output)
+                offset += len(encoded)
+                previous = block_docs[-1]
+        output.close()
+        for run_file in self.runs:
+            remove(run_file)
+        np.save(self.path + 'terms.npy', terms)
+        np.save(self.path + 'blocks.npy', np.array(blocks, dtype=np.int64).reshape(-1, 2))
+        np.save(self.path + 'lengths.npy', lengths)
+        block_max = np.array(block_max, dtype=np.float64).reshape(-1, 3)
+        np.save(self.path + 'block_max.npy', block_max)
+        term_max = np.zeros((len(words), 3))
+        for word_id, (offset, count, first_block) in enumerate(terms):
+            if count:
+                last_block = first_block + (count + self.block_size - 1) // self.block_size
+                term_max[word_id] = block_max[first_block:last_block].max(axis=0)
+        np.save(self.path + 'term_max.npy', term_max)
+        output = open(self.path + 'words.txt', 'w')
+        output.writelines(word + '\n' for word in words)
+        output.close()
+        output = open(self.path + 'docs.txt', 'w')
+        output.writelines(str(obj_id) + '\n' for obj_id in self.doc_ids)
+        output.close()
+        meta = {'depth': self.depth, 'block_size': self.block_size, 'docs': len(self.doc_ids),
+                'words': len(words), 'size': offset, 'avg_length': avg_length}
+        output = open(self.path + 'meta.json', 'w')
+        json.dump(meta, output)
+        output.close()
+
+
+class PostingsReader(object):
+    """Memory-mapped access to the postings written by PostingsWriter"""
+
+    def __init__(self, postings_path):
+        self.path = postings_path
+        meta = json.load(open(self.path + 'meta.json'))
+        self.depth = meta['depth']
+        self.block_size = meta['block_size']
+        if meta['size']:
+            self.data = np.memmap(self.path + 'postings.bin', dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+        self.terms = np.load(self.path + 'terms.npy', mmap_mode='r')
+        self.blocks = np.load(self.path + 'blocks.npy', mmap_mode='r')
+        self.lengths = np.load(self.path + 'lengths.npy', mmap_mode='r')
+        self.avg_length = meta.get('avg_length')
+        if path.isfile(self.path + 'term_max.npy'):
+            self.block_max = np.load(self.path + 'block_max.npy', mmap_mode='r')
+            self.term_max = np.load(self.path + 'term_max.npy', mmap_mode='r')
+        else:
+            self.block_max = self.term_max = None
+        self.word_ids = dict((line.rstrip('\n'), word_id) for word_id, line in enumerate(open(self.path + 'words.txt')))
+        if self.depth:
+            self.doc_ids = [line.rstrip('\n') for line in open(self.path + 'docs.txt')]
+        else:
+            self.doc_ids = [int(line) for line in open(self.path + 'docs.txt')]
+        self.doc_count = len(self.doc_ids)
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def doc_freq(self, word):
+        if word not in self.word_ids:
+            return 0
+        return int(self.terms[self.word_ids[word]][1])
+
+    def decode_blocks(self, word_id, first, last):
+        """Decode the blocks between first and last (relative to the word's first block)
+        and return their doc numbers and frequencies"""
+        if first >= last:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        offset, count, first_block = self.terms[word_id]
+        start = self.blocks[first_block + first][1]
+        if last < self.block_count(word_id):
+            end = self.blocks[first_block + last][1]
+        else:
+            end = offset + self.term_size(word_id)
+        values = varint_decode(self.data[start:end])
+        docs = []
+        freqs = []
+        position = 0
+        for block in xrange(first, last):
+            size = min(self.block_size, count - block * self.block_size)
+            if block:
+                previous = self.blocks[first_block + block - 1][0]
+            else:
+                previous = 0
+            docs.append(np.cumsum(values[position:position + size]) + previous)
+            freqs.append(values[position + size:position + 2 * size])
+            position += 2 * size
+        if not docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(docs), np.concatenate(freqs)
+
+    def block_count(self, word_id):
+        count = self.terms[word_id][1]
+        return (count + self.block_size - 1) // self.block_size
+
+    def term_size(self, word_id):
+        """Number of bytes used by the postings of a word"""
+        if word_id + 1 < len(self.terms):
+            return self.terms[word_id + 1][0] - self.terms[word_id][0]
+        return len(self.data) - self.terms[word_id][0]
+
+    def postings(self, word):
+        """Return the doc numbers, frequencies and doc lengths of a word as arrays"""
+        if word not in self.word_ids:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        word_id = self.word_ids[word]
+        docs, freqs = self.decode_blocks(word_id, 0, self.block_count(word_id))
+        return docs, freqs, self.lengths[docs]
+
+    def postings_in(self, word, docs):
+        """Return the postings of a word restricted to the sorted doc numbers in docs,
+        decoding only the blocks which can contain them"""
+        empty = np.zeros(0, dtype=np.int64)
+        if word not in self.word_ids or not len(docs):
+            return empty, empty, empty
+        word_id = self.word_ids[word]
+        offset, count, first_block = self.terms[word_id]
+        block_count = self.block_count(word_id)
+        last_docs = self.blocks[first_block:first_block + block_count, 0]
+        needed = np.unique(np.searchsorted(last_docs, docs, side='left'))
+        needed = needed[needed < block_count]
+        if not len(needed):
+            return empty, empty, empty
+        ## decode each run of consecutive blocks at once
+        breaks = np.flatnonzero(np.diff(needed) > 1) + 1
+        found_docs = []
+        found_freqs = []
+        for run in np.split(needed, breaks):
+            run_docs, run_freqs = self.decode_blocks(word_id, run[0], run[-1] + 1)
+            found_docs.append(run_docs)
+            found_freqs.append(run_freqs)
+        found_docs = np.concatenate(found_docs)
+        found_freqs = np.concatenate(found_freqs)
+        keep = np.in1d(found_docs, docs, assume_unique=True)
+        found_docs = found_docs[keep]
+        return found_docs, found_freqs[keep], self.lengths[found_docs]
+
+    def postings_many(self, words):
+        """Return the postings of several words decoded together: doc numbers,
+        frequencies and doc lengths of all words one after the other, and the
+        bounds of each word's postings in these arrays"""
+        counts = np.array([self.terms[self.word_ids[word]][1] if word in self.word_ids else 0 for word in words],
+                          dtype=np.int64)
+        bounds = np.concatenate(([0], np.cumsum(counts)))
+        ## words without postings have no blocks to decode
+        word_ids = [self.word_ids[word] for word, count in zip(words, counts) if count]
+        if not word_ids:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, bounds
+        values = varint_decode(np.concatenate([self.data[self.terms[word_id][0]:self.terms[word_id][0] + self.term_size(word_id)]
+                                               for word_id in word_ids]))
+        ## size and last doc of the previous block of every block, in decoding order
+        sizes = []
+        previous = []
+        for word_id in word_ids:
+            offset, count, first_block = self.terms[word_id]
+            block_count = self.block_count(word_id)
+            block_sizes = np.full(block_count, self.block_size, dtype=np.int64)
+            block_sizes[-1] = count - (block_count - 1) * self.block_size
+            sizes.append(block_sizes)
+            previous.append(np.concatenate(([0], self.blocks[first_block:first_block + block_count - 1, 0])))
+        sizes = np.concatenate(sizes)
+        previous = np.concatenate(previous)
+        ## each block holds its doc number gaps followed by its frequencies
+        block_starts = np.cumsum(2 * sizes) - 2 * sizes
+        first_postings = np.cumsum(sizes) - sizes
+        within_block = np.arange(sizes.sum()) - np.repeat(first_postings, sizes)
+        gap_positions = np.repeat(block_starts, sizes) + within_block
+        gaps = values[gap_positions]
+        totals = np.cumsum(gaps)
+        block_totals = np.repeat(totals[first_postings] - gaps[first_postings], sizes)
+        docs = totals - block_totals + np.repeat(previous, sizes)
+        freqs = values[gap_positions + np.repeat(sizes, sizes)]
+        return docs, freqs, self.lengths[docs], bounds
+
+    def max_scores(self, word):
+        """Highest frequency, frequency / length and BM25 part of a word's postings"""
+        return self.term_max[self.word_ids[word]]
+
+    def obj_ids(self, docs):
+        return [self.doc_ids[doc] for doc in docs]
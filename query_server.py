@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import threading
+import traceback
+import urlparse
+from Queue import Queue
+from optparse import OptionParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import UnixStreamServer
+import data_handler
+import postings
+import corpus_stats
+import word_mapper
+import headword_index
+import topic_expansion
+from data_handler import LRUCache
+from ranked_relevance import Searcher
+from knn_helper import knn
+
+
+class QueryService(object):
+    """Answers searches, KNN lookups and document information requests for any
+    database under path, keeping what each database loads in memory between requests.
+    Indexes are reloaded when their files change, or all at once with reload()."""
+
+    def __init__(self, path='/var/lib/philologic/databases/', cached_queries=64):
+        self.path = path
+        self.cached_queries = cached_queries
+        self.lock = threading.Lock()
+        self.routes = {'search': self.search, 'lda_search': self.lda_search, 'knn': self.knn,
+                       'metadata': self.metadata, 'excerpts': self.excerpts, 'reload': self.reload}
+        self.reload()
+
+    def reload(self, params=None):
+        """Forget every loaded index, so that the next requests read them again"""
+        with self.lock:
+            self.neighbors = {}
+            self.doc_infos = {}
+            if hasattr(self, 'excerpt_infos'):
+                self.excerpt_infos.clear()
+            self.excerpt_infos = LRUCache(self.cached_queries, on_evict=self.close_excerpt_info)
+        for cache in (data_handler.sparse_matrices, data_handler.philo_dbs, data_handler.doc_lengths,
+                      postings.postings_cache, corpus_stats.loaded_stats, word_mapper.lexicons,
+                      headword_index.loaded_indexes, topic_expansion.loaded_models):
+            cache.clear()
+        return {'reloaded': True}
+
+    def close_excerpt_info(self, (doc_info, lock)):
+        """Close the files of an evicted DocInfo once no request is reading excerpts from it.
+        A request which got it just before will reopen the files it needs."""
+        with lock:
+            doc_info.close()
+
+    def warm(self, db):
+        """Load the search indexes of a database ahead of the first request"""
+        Searcher('', db, path=self.path)
+        word_mapper.mapper(self.path + db + '/')
+
+    def search(self, params):
+        searcher = self.__searcher(params)
+        return searcher.search(param(params, 'measure', 'tf_idf'), param(params, 'scoring', 'simple_scoring'),
+                               param(params, 'intersect', False, boolean), param(params, 'display', 10, int))
+
+    def lda_search(self, params):
+        searcher = self.__searcher(params)
+        return searcher.lda_search(param(params, 'measure', 'tf_idf'), param(params, 'scoring', 'simple_scoring'),
+                                   param(params, 'intersect', False, boolean), param(params, 'display', 10, int))
+
+    def __searcher(self, params):
+        return Searcher(param(params, 'q'), param(params, 'db'), param(params, 'doc_level', True, boolean),
+                        param(params, 'stemmer', False), self.path, param(params, 'backend', None))
+
+    def knn(self, params):
+        """Neighbors of every obj_id given"""
+        key = (param(params, 'db'), param(params, 'measure', 'cosine'), param(params, 'db_name', False))
+        with self.lock:
+            if key not in self.neighbors:
+                self.neighbors[key] = (knn(key[0], self.path, key[1], key[2]), threading.Lock())
+        neighbors, lock = self.neighbors[key]
+        with lock:
+            return neighbors.search_many(params.get('obj_id', []), param(params, 'display', 10, int))
+
+    def metadata(self, params):
+        """Metadata fields of every obj_id given"""
+        db = param(params, 'db')
+        with self.lock:
+            if db not in self.doc_infos:
+                from doc_info import DocInfo
+                self.doc_infos[db] = (DocInfo(db, path=self.path), threading.Lock())
+        doc_info, lock = self.doc_infos[db]
+        with lock:
+            return doc_info.get_metadata_many(params.get('obj_id', []), params.get('field', ['title']))
+
+    def excerpts(self, params):
+        """Excerpts of every doc_id given, with the hitlists of recent queries kept warm"""
+        key = (param(params, 'db'), param(params, 'q'))
+        with self.lock:
+            if key not in self.excerpt_infos:
+                from doc_info import DocInfo
+                self.excerpt_infos[key] = (DocInfo(key[0], key[1], self.path), threading.Lock())
+            doc_info, lock = self.excerpt_infos.get(key)
+        with lock:
+            return doc_info.get_excerpts(params.get('doc_id', []), param(params, 'highlight', False, boolean))
+
+
+def boolean(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+def param(params, name, default=KeyError, convert=None):
+    """First value of a query string parameter"""
+    if name not in params:
+        if default is KeyError:
+            raise KeyError('missing parameter %s' % name)
+        return default
+    value = params[name][0]
+    if convert is not None:
+        return convert(value)
+    return value
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET /<route>?db=...&q=... and similar, answered in JSON"""
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        route = self.server.service.routes.get(url.path.strip('/'))
+        if route is None:
+            return self.reply(404, {'error': 'unknown request %s' % url.path})
+        params = urlparse.parse_qs(url.query)
+        try:
+            result = route(params)
+        except (KeyError, ValueError), error:
+            return self.reply(400, {'error': str(error)})
+        except Exception, error:
+            traceback.print_exc()
+            return self.reply(500, {'error': str(error)})
+        self.reply(200, result)
+
+    def reply(self, code, result):
+        body = json.dumps(result)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return BaseHTTPRequestHandler.address_string(self)
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class PoolMixIn:
+    """Hand requests to a fixed number of threads instead of one new thread each"""
+
+    def start_pool(self, threads):
+        self.requests = Queue(threads * 4)
+        for i in xrange(threads):
+            thread = threading.Thread(target=self.serve_requests)
+            thread.daemon = True
+            thread.start()
+
+    def serve_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+
+class QueryServer(PoolMixIn, HTTPServer):
+    pass
+
+
+class UnixQueryServer(PoolMixIn, UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(service, port=8000, host='127.0.0.1', unix_socket=None, threads=8, verbose=False):
+    """HTTP server answering requests with service, on a local port or a Unix socket"""
+    if unix_socket:
+        server = UnixQueryServer(unix_socket, QueryHandler)
+    else:
+        server = QueryServer((host, port), QueryHandler)
+    server.service = service
+    server.verbose = verbose
+    server.start_pool(threads)
+    return server
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [db ...]')
+    parser.add_option('--path', default='/var/lib/philologic/databases/')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--socket', help='listen on this Unix socket instead of a port')
+    parser.add_option('--threads', type='int', default=8)
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, dbs = parser.parse_args()
+    service = QueryService(options.path)
+    for db in dbs:
+        service.warm(db)
+    server = make_server(service, options.port, options.host, options.socket, options.threads, options.verbose)
+    print >> sys.stderr, 'Serving %s on %s' % (options.path, options.socket or '%s:%d' % (options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    if options.socket:
+        os.remove(options.socket)
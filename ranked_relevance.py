@@ -1,29 +1,44 @@
 #!/usr/bin/env python
 
-import json
+import numpy as np
 from math import log, floor
+from multiprocessing import Pool
 from operator import itemgetter
+from os import path as os_path
 from word_mapper import mapper
 from data_handler import *
+from postings import has_postings, load_postings
+from topic_expansion import expansion_model
+from instrument import get_instrument
 
 
 class Searcher(object):
     """Run a search on documents or objects within documents
-    in the SQLite table
+    in the packed postings, or in the SQLite table for databases indexed without them
     Three scoring options are available: Frequency, TF-IDF and BM25
     Two methods of incrementing the scores of results are available:
     simple addition or best score"""
     
     
-    def __init__(self, query, db, doc_level_search=True, stemmer=False, path='/var/lib/philologic/databases/'):
+    def __init__(self, query, db, doc_level_search=True, stemmer=False, path='/var/lib/philologic/databases/', backend=None,
+                 instrument=None):
+        """backend is either 'postings' or 'sqlite'. By default the postings are used when they exist.
+        instrument times the stages of each search, see instrument.get_instrument"""
+        self.db = db
         self.path = path + db + '/'
+        self.instrument = get_instrument(instrument)
         self.words = query.split()
         self.doc_level_search = doc_level_search
         self.results = {}
+        self.mapper = None
+        self.stats = corpus_stats(self.path)
+        self.postings = None
+        if backend != 'sqlite' and has_postings(self.path + 'postings/'):
+            self.postings = load_postings(self.path + 'postings/')
         if doc_level_search:
              self.doc_path = self.path + 'doc_arrays/'
         else:
-            self.doc_path = self.path + 'obj_arrays/'
+            self.doc_path = obj_arrays_path(self.path)
         self.stemmer = stemmer
         if stemmer:
             try:
@@ -37,7 +52,12 @@ class Searcher(object):
         
     def get_hits(self, word, doc=True):
         """Query the SQLite table and return a list of tuples containing the results"""
-        cursor = sqlite_conn(self.path + 'hits_per_word.sqlite')
+        if self.postings is not None:
+            docs, freqs, lengths = self.postings.postings(word)
+            return zip(self.postings.obj_ids(docs), freqs.tolist(), lengths.tolist())
+        if not os_path.isfile(self.path + 'hits_per_word.sqlite'):
+            return []
+        cursor = pooled_conn(self.path + 'hits_per_word.sqlite')
         if self.doc_level_search:
             cursor.execute('select doc_id, word_freq, total_words from doc_hits where word=?', (word,))
         else:
@@ -46,24 +66,46 @@ class Searcher(object):
         
     def id_to_word(self, id):
         """Return the word given its ID"""
-        m = mapper(self.path)
-        return m[id]
+        if self.mapper is None:
+            self.mapper = mapper(self.path)
+        return self.mapper[id]
         
     def get_idf(self, hits):
         """Return IDF score"""
-        total_docs = doc_counter(self.doc_path) #### WRONG COUNT
+        return self.idf(len(hits))
+        
+    def idf(self, doc_freq):
+        total_docs = self.stats.doc_count
         try:
-            return log(float(total_docs) / float(len(hits))) + 1
+            return log(float(total_docs) / float(doc_freq)) + 1
         except ZeroDivisionError:
             return 0
                
-    def search(self, measure='tf_idf', scoring='simple_scoring', intersect=False, display=10):
-        """Searcher function"""
+    def search(self, measure='tf_idf', scoring='simple_scoring', intersect=False, display=10, top_k=True):
+        """Searcher function
+        With the postings backend, top_k skips the documents which cannot make it
+        into the display best results, unless intersect is set"""
+        if measure not in MEASURES:
+            raise ValueError('unknown measure %s' % measure)
+        with self.instrument.timer('total'):
+            results = self.__search(measure, scoring, intersect, display, top_k)
+        self.instrument.emit('search', db=self.db, words=self.words, measure=measure, scoring=scoring,
+                             intersect=intersect, backend='sqlite' if self.postings is None else 'postings')
+        return results
+
+    def __search(self, measure, scoring, intersect, display, top_k):
+        if self.postings is not None:
+            if top_k and not intersect and self.postings.term_max is not None:
+                return self.top_k_search(measure, scoring, display)
+            return self.postings_search(measure, scoring, intersect, display)
         self.intersect = False
         if self.words != []:
             for word in self.words:
-                hits = self.get_hits(word)
-                getattr(self, measure)(hits, scoring)
+                with self.instrument.timer('get_hits'):
+                    hits = self.get_hits(word)
+                self.instrument.count('postings', len(hits))
+                with self.instrument.timer('score'):
+                    getattr(self, measure)(hits, scoring)
                 if intersect:
                     if self.intersect:
                         self.docs = self.docs.intersection(self.new_docs)
@@ -74,16 +116,165 @@ class Searcher(object):
                         self.new_docs = set([])
             if intersect:
                 self.results = dict([(obj_id, self.results[obj_id]) for obj_id in self.results if obj_id in self.docs])
-            return sorted(self.results.iteritems(), key=itemgetter(1), reverse=True)[:display]
+            self.instrument.count('documents_scored', len(self.results))
+            with self.instrument.timer('sort'):
+                return sorted(self.results.iteritems(), key=itemgetter(1), reverse=True)[:display]
         else:
             return []
     
+    def postings_search(self, measure, scoring, intersect, display):
+        """Score whole postings lists at once with numpy"""
+        if self.words == []:
+            return []
+        scores = np.zeros(self.postings.doc_count)
+        matches = np.zeros(self.postings.doc_count, dtype=np.int32)
+        for word in self.words:
+            with self.instrument.timer('get_hits'):
+                docs, freqs, lengths = self.postings.postings(word)
+            self.instrument.count('postings', len(docs))
+            with self.instrument.timer('score'):
+                word_scores = self.score_postings(measure, freqs, lengths)
+                if scoring == 'dismax_scoring':
+                    scores[docs] = np.maximum(scores[docs], word_scores)
+                else:
+                    scores[docs] += word_scores
+                matches[docs] += 1
+        if intersect:
+            candidates = np.flatnonzero(matches == len(self.words))
+        else:
+            candidates = np.flatnonzero(matches)
+        self.instrument.count('documents_scored', len(candidates))
+        return self.top_results(candidates, scores[candidates], display)
+    
+    def top_k_search(self, measure, scoring, display):
+        """MaxScore search: words are scored from the highest score upper bound
+        to the lowest. Once the bounds of the remaining words cannot lift an unseen
+        document above the current display-th best score, only the postings blocks
+        holding the remaining candidates are decoded. The candidates' scores are then
+        summed again in query order so that results match postings_search"""
+        if self.words == [] or display <= 0:
+            return []
+        dismax = scoring == 'dismax_scoring'
+        bounds = [self.upper_bound(measure, word) for word in self.words]
+        order = sorted(range(len(self.words)), key=lambda i: -bounds[i])
+        scores = np.zeros(self.postings.doc_count)
+        seen = np.zeros(self.postings.doc_count, dtype=bool)
+        candidates = None
+        threshold = -np.inf
+        word_scores = {}
+        for position, i in enumerate(order):
+            word = self.words[i]
+            remaining = [bounds[j] for j in order[position:]]
+            if dismax:
+                remaining = max(remaining)
+            else:
+                remaining = sum(remaining)
+            if candidates is None and remaining < threshold:
+                candidates = np.flatnonzero(seen)
+            with self.instrument.timer('get_hits'):
+                if candidates is None:
+                    docs, freqs, lengths = self.postings.postings(word)
+                else:
+                    candidates = self.prune(candidates, scores, remaining, threshold, dismax)
+                    docs, freqs, lengths = self.postings.postings_in(word, candidates)
+            self.instrument.count('postings', len(docs))
+            with self.instrument.timer('score'):
+                word_scores[i] = (docs, self.score_postings(measure, freqs, lengths, self.postings.doc_freq(word)))
+                if dismax:
+                    scores[docs] = np.maximum(scores[docs], word_scores[i][1])
+                else:
+                    scores[docs] += word_scores[i][1]
+                seen[docs] = True
+            with self.instrument.timer('prune'):
+                threshold = self.threshold(scores[seen], display)
+        if candidates is None:
+            candidates = np.flatnonzero(seen)
+        candidates = self.prune(candidates, scores, 0, threshold, dismax)
+        self.instrument.count('documents_scored', len(candidates))
+        exact = np.zeros(len(candidates))
+        with self.instrument.timer('score'):
+            for i in xrange(len(self.words)):
+                docs, doc_scores = word_scores[i]
+                index = np.searchsorted(candidates, docs)
+                found = index < len(candidates)
+                found[found] = candidates[index[found]] == docs[found]
+                if dismax:
+                    exact[index[found]] = np.maximum(exact[index[found]], doc_scores[found])
+                else:
+                    exact[index[found]] += doc_scores[found]
+        return self.top_results(candidates, exact, display)
+    
+    def upper_bound(self, measure, word, k1=1.2, b=0.75):
+        """Highest score a single word can give a document"""
+        if word not in self.postings:
+            return 0.0
+        max_freq, max_ratio, max_bm25 = self.postings.max_scores(word)
+        if measure == 'debug_score':
+            return max_freq
+        if measure == 'frequency':
+            return max_ratio
+        idf = self.idf(self.postings.doc_freq(word))
+        if measure == 'tf_idf':
+            return idf * max_ratio
+        if self.postings.avg_length != self.stats.avg_length:
+            ## the stored maxima were computed with another average length
+            max_bm25 = k1 + 1.0
+        return idf * max_bm25
+    
+    def threshold(self, scores, display):
+        """Lowest score in the current top display, lowered by a small margin
+        so that rounding differences never prune a result"""
+        if len(scores) < display:
+            return -np.inf
+        kth = np.partition(scores, len(scores) - display)[len(scores) - display]
+        return kth - 1e-9 * abs(kth)
+    
+    def prune(self, candidates, scores, remaining, threshold, dismax):
+        """Drop candidates which cannot reach threshold with the remaining words"""
+        if dismax:
+            best = np.maximum(scores[candidates], remaining)
+        else:
+            best = scores[candidates] + remaining
+        return candidates[best >= threshold]
+    
+    def score_postings(self, measure, freqs, lengths, doc_freq=None, k1=1.2, b=0.75):
+        """Array version of the frequency, tf_idf, bm25 and debug_score measures.
+        doc_freq defaults to the number of postings given"""
+        freqs = freqs.astype(np.float64)
+        lengths = lengths.astype(np.float64)
+        if measure == 'debug_score':
+            return freqs
+        if measure == 'frequency':
+            return freqs / lengths
+        if doc_freq is None:
+            doc_freq = len(freqs)
+        with self.instrument.timer('idf'):
+            idf = self.idf(doc_freq)
+        if measure == 'tf_idf':
+            return freqs / lengths * idf
+        avg_dl = self.stats.avg_length
+        return idf * (freqs * (k1 + 1.0)) / (freqs + k1 * ((1.0 - b) + b * np.floor(lengths / avg_dl)))
+    
+    def top_results(self, docs, scores, display):
+        """Return the display best (obj_id, score), ties going to the first indexed docs"""
+        with self.instrument.timer('sort'):
+            if len(docs) > display:
+                kth = -np.partition(-scores, display - 1)[display - 1]
+                best = scores >= kth
+                docs, scores = docs[best], scores[best]
+            order = np.lexsort((docs, -scores))[:display]
+            return zip(self.obj_ids(docs[order]), scores[order].tolist())
+
+    def obj_ids(self, docs):
+        return self.postings.obj_ids(docs)
+    
     def debug_score(self, hits, scoring):
         for obj_id, word_freq, word_sum in hits:
             getattr(self, scoring)(obj_id, word_freq)
     
     def tf_idf(self, hits, scoring):
-        idf = self.get_idf(hits)
+        with self.instrument.timer('idf'):
+            idf = self.get_idf(hits)
         for obj_id, word_freq, word_sum in hits:
             tf = float(word_freq) / float(word_sum)
             score = tf * idf
@@ -98,8 +289,9 @@ class Searcher(object):
         ## a floor is applied to normalized length of doc
         ## in order to diminish the importance of small docs
         ## see http://xapian.org/docs/bm25.html
-        idf = self.get_idf(hits)
-        avg_dl = avg_doc_length(self.path)
+        with self.instrument.timer('idf'):
+            idf = self.get_idf(hits)
+        avg_dl = self.stats.avg_length
         for obj_id, word_freq, obj_length in hits:
             tf = float(word_freq)
             dl = float(obj_length)
@@ -127,62 +319,75 @@ class Searcher(object):
                 
     def lda_search(self, measure='tf_idf', scoring='simple_scoring', intersect=False, display=10):
         """Searcher function"""
+        if measure not in MEASURES:
+            raise ValueError('unknown measure %s' % measure)
+        with self.instrument.timer('total'):
+            results = self.__lda_search(measure, scoring, intersect, display)
+        self.instrument.emit('lda_search', db=self.db, words=self.words, measure=measure, scoring=scoring,
+                             backend='sqlite' if self.postings is None else 'postings')
+        return results
+
+    def __lda_search(self, measure, scoring, intersect, display):
         self.intersect = False
         self.words = [words.decode('utf-8') for words in self.words]
         if self.words != []:
-            lda_query = self.match_topic()
+            with self.instrument.timer('expansion'):
+                lda_query = self.match_topic()
             if lda_query != None:
                 for word in self.words[:1]:  # temporary slice, to offer it as an option?
                     lda_query[word] = sum([lda_query[term] for term in lda_query])
                 print lda_query
+                if self.postings is not None:
+                    return self.lda_postings_search(lda_query, measure, display)
                 self.num_hits = {}
                 for other_word, freq in lda_query.iteritems():
-                    hits = self.get_hits(other_word)
-                    results = self.lda_scoring(hits, scoring, freq, measure)
+                    with self.instrument.timer('get_hits'):
+                        hits = self.get_hits(other_word)
+                    self.instrument.count('postings', len(hits))
+                    with self.instrument.timer('score'):
+                        results = self.lda_scoring(hits, scoring, freq, measure)
                 self.results = dict([(obj_id, self.results[obj_id] * self.num_hits[obj_id]) for obj_id in self.results if self.num_hits[obj_id] > 1])
-                return sorted(self.results.iteritems(), key=itemgetter(1), reverse=True)[:display]
+                self.instrument.count('documents_scored', len(self.results))
+                with self.instrument.timer('sort'):
+                    return sorted(self.results.iteritems(), key=itemgetter(1), reverse=True)[:display]
             else:
                 return []
         else:
             return []
+
+    def lda_postings_search(self, lda_query, measure, display):
+        """Same scoring as lda_scoring, with the postings of all expansion words decoded at once"""
+        words = lda_query.keys()
+        with self.instrument.timer('get_hits'):
+            docs, freqs, lengths, bounds = self.postings.postings_many([word.encode('utf-8') for word in words])
+        self.instrument.count('postings', len(docs))
+        if measure != 'tf_idf':
+            measure = 'bm25'
+        scores = np.zeros(self.postings.doc_count)
+        num_hits = np.zeros(self.postings.doc_count, dtype=np.int32)
+        with self.instrument.timer('score'):
+            for i, word in enumerate(words):
+                word_docs = docs[bounds[i]:bounds[i + 1]]
+                word_scores = self.score_postings(measure, freqs[bounds[i]:bounds[i + 1]], lengths[bounds[i]:bounds[i + 1]])
+                scores[word_docs] += word_scores * lda_query[word]
+                num_hits[word_docs] += 1
+        candidates = np.flatnonzero(num_hits > 1)
+        self.instrument.count('documents_scored', len(candidates))
+        return self.top_results(candidates, scores[candidates] * num_hits[candidates], display)
             
-    def match_topic(self):
-        topic_id = int
-        cursor = sqlite_conn(self.path + 'lda_topics.sqlite')
-        if len(self.words) == 1:
-            cursor.execute('select topic, position from word_position where word=? order by position', (self.words[0],))
-            try:
-                topic_id = cursor.fetchone()[0]
-            except TypeError:
-                return None
-        else:
-            topic_pos = {}
-            topic_matches = {}
-            query = 'select topic, position from word_position where word="%s"' % self.words[0]
-            for word in self.words[1:]:
-                query += ' or word="%s"' % word
-            cursor.execute(query)
-            for topic, position in cursor.fetchall():
-                if topic not in topic_pos:
-                    topic_pos[topic] = position
-                    topic_matches[topic] = 1
-                else:
-                    topic_pos[topic] += position
-                    topic_matches[topic] += 1
-            word_num = len(self.words)
-            topics = [(topic, topic_pos[topic]) for topic in topic_pos if topic_matches[topic] == word_num]
-            if topics == []:
-                topics = [(topic, topic_pos[topic]) for topic in topic_pos if topic_matches[topic] == word_num - 1]
-            topic_id = sorted(topics, key=itemgetter(1))[0][0]
-        cursor.execute('select words from topics where topic=?', (topic_id,))
-        results = json.loads(cursor.fetchone()[0])
-        topic = [(term, float(freq)) for term, freq in results.iteritems()]# if float(freq) > 0.01]
-        topic = dict(sorted(topic, key=itemgetter(1), reverse=True)[:10])
-        return topic
+    def match_topic(self, terms=10):
+        """Return the terms most likely in the topic which best matches the query words,
+        with their weights"""
+        model = expansion_model(self.path, terms)
+        topic = model.match_topic(self.words)
+        if topic is None:
+            return None
+        return model.expansion(topic)
         
     def lda_scoring(self, hits, scoring, freq, measure):
         if measure == 'tf_idf':
-            idf = self.get_idf(hits)
+            with self.instrument.timer('idf'):
+                idf = self.get_idf(hits)
             for obj_id, word_freq, word_sum in hits:
                 tf = float(word_freq) / float(word_sum)
                 score = tf * idf * freq
@@ -193,8 +398,9 @@ class Searcher(object):
                     self.results[obj_id] += score    
                     self.num_hits[obj_id] += 1
         else:
-            idf = self.get_idf(hits)
-            avg_dl = avg_doc_length(self.path)
+            with self.instrument.timer('idf'):
+                idf = self.get_idf(hits)
+            avg_dl = self.stats.avg_length
             k1 = 1.2
             b = 0.75
             for obj_id, word_freq, obj_length in hits:
@@ -238,4 +444,132 @@ class Searcher(object):
     
     
     
-    
\ No newline at end of file
+    
+
+## Measures of Searcher.search, and the options each query of BatchSearcher.search_many can set
+MEASURES = ('tf_idf', 'bm25', 'frequency', 'debug_score')
+QUERY_OPTIONS = {'measure': 'tf_idf', 'scoring': 'simple_scoring', 'intersect': False, 'display': 10}
+
+
+def search_query(query):
+    """Score a query of search_many in a worker process"""
+    return batch_searcher.search_query(query)
+
+
+class BatchSearcher(Searcher):
+    """Run many queries on one database. The postings of each distinct word are fetched
+    once for the whole batch and scored once per measure, so that queries sharing words
+    share the work. Results are the same as with one Searcher per query, except for the
+    order of equal scores with the SQLite backend.
+
+    searcher = BatchSearcher(db)
+    results = searcher.search_many(['some words', {'query': 'other words', 'measure': 'bm25', 'display': 20}])"""
+
+    def __init__(self, db, doc_level_search=True, stemmer=False, path='/var/lib/philologic/databases/', backend=None,
+                 instrument=None):
+        Searcher.__init__(self, '', db, doc_level_search, stemmer, path, backend, instrument)
+        self.word_postings = {}
+        self.word_scores = {}
+        self.doc_numbers = {}
+        self.doc_ids = []
+
+    def search_many(self, queries, workers=1):
+        """Return the results of each query, in order. A query is either a string or a dict
+        holding the string under 'query' along with any of measure, scoring, intersect and
+        display, which default to the ones of Searcher.search.
+        With several workers, queries are scored in forked processes which share the
+        postings fetched beforehand."""
+        global batch_searcher
+        queries = [self.query_options(query) for query in queries]
+        with self.instrument.timer('total'):
+            words = set(word for query in queries for word in query['words'])
+            with self.instrument.timer('get_hits'):
+                self.fetch(words)
+            with self.instrument.timer('score'):
+                for query in queries:
+                    for word in query['words']:
+                        self.scores(word, query['measure'])
+            if workers > 1 and len(queries) > workers:
+                batch_searcher = self
+                pool = Pool(workers)
+                results = pool.map(search_query, queries, max(1, len(queries) // (workers * 4)))
+                pool.close()
+                pool.join()
+                batch_searcher = None
+            else:
+                results = [self.search_query(query) for query in queries]
+        self.instrument.count('queries', len(queries))
+        self.instrument.emit('search_many', db=self.db, words=len(words), workers=workers,
+                             backend='sqlite' if self.postings is None else 'postings')
+        return results
+
+    def query_options(self, query):
+        if isinstance(query, basestring):
+            query = {'query': query}
+        unknown = set(query) - set(QUERY_OPTIONS) - set(['query'])
+        if unknown:
+            raise ValueError('unknown search options: %s' % ', '.join(sorted(unknown)))
+        options = dict(QUERY_OPTIONS)
+        options.update(query)
+        if options['measure'] not in MEASURES:
+            raise ValueError('unknown measure %s' % options['measure'])
+        options['words'] = options['query'].split()
+        if hasattr(self.stemmer, 'stemWord'):
+            options['words'] = [self.stemmer.stemWord(word) for word in options['words']]
+        return options
+
+    def fetch(self, words):
+        """Read the postings of the words not fetched yet, all at once with the postings backend"""
+        words = [word for word in words if word not in self.word_postings]
+        if self.postings is not None:
+            docs, freqs, lengths, bounds = self.postings.postings_many(words)
+            for i, word in enumerate(words):
+                self.word_postings[word] = (docs[bounds[i]:bounds[i + 1]], freqs[bounds[i]:bounds[i + 1]],
+                                            lengths[bounds[i]:bounds[i + 1]])
+            self.instrument.count('postings', len(docs))
+            return
+        for word in words:
+            hits = self.get_hits(word)
+            docs = np.array([self.doc_number(obj_id) for obj_id, word_freq, total_words in hits], dtype=np.int64)
+            freqs = np.array([word_freq for obj_id, word_freq, total_words in hits], dtype=np.int64)
+            lengths = np.array([total_words for obj_id, word_freq, total_words in hits], dtype=np.int64)
+            self.word_postings[word] = (docs, freqs, lengths)
+            self.instrument.count('postings', len(hits))
+
+    def doc_number(self, obj_id):
+        """Number the objects found in the SQLite table in the order they are met"""
+        if obj_id not in self.doc_numbers:
+            self.doc_numbers[obj_id] = len(self.doc_ids)
+            self.doc_ids.append(obj_id)
+        return self.doc_numbers[obj_id]
+
+    def obj_ids(self, docs):
+        if self.postings is not None:
+            return self.postings.obj_ids(docs)
+        return [self.doc_ids[doc] for doc in docs]
+
+    def scores(self, word, measure):
+        """Scores of the postings of a fetched word, with its IDF, computed once per measure"""
+        if (word, measure) not in self.word_scores:
+            docs, freqs, lengths = self.word_postings[word]
+            self.word_scores[(word, measure)] = self.score_postings(measure, freqs, lengths)
+        return self.word_scores[(word, measure)]
+
+    def search_query(self, query):
+        """Same scoring as postings_search, over the documents of the query words only"""
+        words = query['words']
+        if words == [] or query['display'] <= 0:
+            return []
+        docs = np.concatenate([self.word_postings[word][0] for word in words])
+        word_scores = np.concatenate([self.scores(word, query['measure']) for word in words])
+        candidates, inverse = np.unique(docs, return_inverse=True)
+        if query['scoring'] == 'dismax_scoring':
+            scores = np.zeros(len(candidates))
+            np.maximum.at(scores, inverse, word_scores)
+        else:
+            scores = np.bincount(inverse, word_scores, len(candidates))
+        if query['intersect']:
+            matches = np.bincount(inverse, minlength=len(candidates))
+            candidates, scores = candidates[matches == len(words)], scores[matches == len(words)]
+        self.instrument.count('documents_scored', len(candidates))
+        return self.top_results(candidates, scores, query['display'])
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from __future__ import division
+import os
+import mmap
+import struct
+import traceback
+import numpy as np
+from multiprocessing import Value
+
+
+## Measures for which an algebraic form over matrix products is available.
+## Any other scipy.spatial.distance measure goes through cdist one tile at a time.
+MATRIX_MEASURES = ('cosine', 'euclidean', 'sqeuclidean', 'correlation')
+
+## Workers report each finished block of rows as its number and its number of neighbors
+BLOCK_NUMBER = struct.Struct('<qq')
+
+
+def is_sparse(matrix):
+    return hasattr(matrix, 'tocsr')
+
+
+class Similarity(object):
+    """Computes similarities (1 - distance) between the rows of a matrix
+    in blocks of rows and columns, using BLAS matrix products.
+    The matrix can be a dense numpy array or a scipy.sparse matrix."""
+
+    def __init__(self, matrix, measure='cosine', block_size=256):
+        if is_sparse(matrix):
+            self.matrix = matrix.tocsr()
+            self.sparse = True
+        else:
+            self.matrix = np.asarray(matrix)
+            self.sparse = False
+        self.measure = measure
+        self.block_size = block_size
+        self.rows, self.dim = self.matrix.shape
+        if measure in MATRIX_MEASURES:
+            self.__init__norms()
+        else:
+            import scipy.spatial.distance
+            self.cdist = scipy.spatial.distance.cdist
+
+    def __init__norms(self):
+        """Precompute the per-row terms used by the algebraic forms of each measure"""
+        if self.sparse:
+            squared = self.matrix.multiply(self.matrix).sum(axis=1)
+            sums = self.matrix.sum(axis=1)
+            self.sq_norms = np.asarray(squared, dtype=np.float64).ravel()
+            self.means = np.asarray(sums, dtype=np.float64).ravel() / self.dim
+        else:
+            self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix, dtype=np.float64)
+            self.means = self.matrix.sum(axis=1, dtype=np.float64) / self.dim
+        if self.measure == 'cosine':
+            self.norms = np.sqrt(self.sq_norms)
+        elif self.measure == 'correlation':
+            centered = self.sq_norms - self.dim * self.means ** 2
+            self.norms = np.sqrt(np.maximum(centered, 0))
+
+    def panel(self, rows):
+        """Return a block of rows as a float64 matrix ready for multiplication"""
+        block = self.matrix[rows]
+        if self.sparse:
+            return block.astype(np.float64)
+        return np.asarray(block, dtype=np.float64)
+
+    def gram(self, left, right):
+        """Dot products between two panels of rows"""
+        product = left.dot(right.T)
+        if self.sparse:
+            product = product.toarray()
+        return np.asarray(product)
+
+    def tile(self, rows, cols, left=None, right=None):
+        """Return the similarities between the rows in the rows slice
+        and the rows in the cols slice"""
+        if left is None:
+            left = self.panel(rows)
+        if right is None:
+            right = self.panel(cols)
+        if self.measure not in MATRIX_MEASURES:
+            if self.sparse:
+                left, right = left.toarray(), right.toarray()
+            return 1 - self.cdist(left, right, self.measure)
+        product = self.gram(left, right)
+        if self.measure == 'cosine':
+            denominator = np.outer(self.norms[rows], self.norms[cols])
+            similarity = product / denominator
+        elif self.measure == 'correlation':
+            covariance = product - self.dim * np.outer(self.means[rows], self.means[cols])
+            denominator = np.outer(self.norms[rows], self.norms[cols])
+            similarity = covariance / denominator
+        else:
+            squared = self.sq_norms[rows][:, None] + self.sq_norms[cols][None, :] - 2 * product
+            squared = np.maximum(squared, 0)
+            if self.measure == 'euclidean':
+                similarity = 1 - np.sqrt(squared)
+            else:
+                similarity = 1 - squared
+        return similarity
+
+    def blocks(self, start=0, end=None):
+        """Iterate over row slices of block_size rows"""
+        if end is None:
+            end = self.rows
+        for block_start in xrange(start, end, self.block_size):
+            yield slice(block_start, min(block_start + self.block_size, end))
+
+    def top_k(self, limit, start=0, end=None, weights=None, columns=None):
+        """For each row between start and end, yield the row range along with
+        the indices and similarities of its limit closest rows, best first.
+        weights is an optional Similarity over the same rows whose similarities
+        multiply the ones of this matrix (used for LDA topic distributions).
+        columns restricts candidate neighbors to a slice of rows."""
+        if columns is None:
+            columns = slice(0, self.rows)
+        candidates = columns.stop - columns.start
+        for rows in self.blocks(start, end):
+            block_rows = rows.stop - rows.start
+            k = min(limit, candidates - min(1, self.overlap(rows, columns)))
+            if k <= 0:
+                yield rows, np.zeros((block_rows, 0), dtype=np.int64), np.zeros((block_rows, 0))
+                continue
+            best_scores = np.empty((block_rows, 0))
+            best_index = np.empty((block_rows, 0), dtype=np.int64)
+            left = self.panel(rows)
+            for cols in self.blocks(columns.start, columns.stop):
+                scores = self.tile(rows, cols, left=left)
+                if weights is not None:
+                    scores = scores * weights.tile(rows, cols)
+                scores = np.nan_to_num(scores)
+                self.mask_self(scores, rows, cols)
+                index = np.broadcast_to(np.arange(cols.start, cols.stop), scores.shape)
+                best_scores, best_index = self.select(np.hstack((best_scores, scores)),
+                                                      np.hstack((best_index, index)), k)
+            order = np.lexsort((best_index, -best_scores), axis=1)
+            line = np.arange(block_rows)[:, None]
+            yield rows, best_index[line, order], best_scores[line, order]
+
+    def overlap(self, rows, cols):
+        return max(0, min(rows.stop, cols.stop) - max(rows.start, cols.start))
+
+    def mask_self(self, scores, rows, cols):
+        """An object is never its own neighbor"""
+        first = max(rows.start, cols.start)
+        last = min(rows.stop, cols.stop)
+        if first < last:
+            diagonal = np.arange(first, last)
+            scores[diagonal - rows.start, diagonal - cols.start] = -np.inf
+
+    def select(self, scores, index, k):
+        """Keep the k best candidates of each row using a partial selection"""
+        if scores.shape[1] <= k:
+            return scores, index
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        line = np.arange(scores.shape[0])[:, None]
+        return scores[line, part], index[line, part]
+
+
+def shared_array(shape, dtype):
+    """Allocate an array in anonymous shared memory, visible to forked children"""
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(mmap.mmap(-1, size), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def share(array):
+    """Copy an array to shared memory"""
+    copy = shared_array(array.shape, array.dtype)
+    copy[...] = array
+    return copy
+
+def share_matrix(matrix):
+    """Copy a dense or sparse matrix to shared memory"""
+    if is_sparse(matrix):
+        from scipy.sparse import csr_matrix
+        matrix = matrix.tocsr()
+        return csr_matrix((share(matrix.data), share(matrix.indices), share(matrix.indptr)),
+                          shape=matrix.shape, copy=False)
+    return share(np.asarray(matrix))
+
+def parallel_top_k(similarity, limit, workers, weights=None, start=0, end=None, columns=None):
+    """Same as Similarity.top_k, computed by workers forked processes.
+    The matrices should be in shared memory (see share_matrix) before the
+    Similarity objects are built, so that every worker reads the same copy.
+    Workers take blocks of rows from a shared counter, write their neighbors in
+    shared result arrays and send the number of each finished block through a pipe.
+    Blocks are yielded in the order they are finished."""
+    if columns is None:
+        columns = slice(0, similarity.rows)
+    width = max(0, min(limit, columns.stop - columns.start))
+    neighbors = shared_array((similarity.rows, width), np.int64)
+    scores = shared_array((similarity.rows, width), np.float64)
+    blocks = list(similarity.blocks(start, end))
+    next_block = Value('l', 0)
+    read_end, write_end = os.pipe()
+    pids = []
+    for worker in xrange(workers):
+        pid = os.fork()
+        if not pid:
+            os.close(read_end)
+            status = 0
+            try:
+                while True:
+                    with next_block.get_lock():
+                        block = next_block.value
+                        next_block.value += 1
+                    if block >= len(blocks):
+                        break
+                    rows = blocks[block]
+                    for rows, block_neighbors, block_scores in similarity.top_k(limit, rows.start, rows.stop, weights, columns):
+                        k = block_neighbors.shape[1]
+                        neighbors[rows, :k] = block_neighbors
+                        scores[rows, :k] = block_scores
+                    os.write(write_end, BLOCK_NUMBER.pack(block, k))
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        pids.append(pid)
+    os.close(write_end)
+    reader = os.fdopen(read_end, 'rb')
+    done = 0
+    while done < len(blocks):
+        message = reader.read(BLOCK_NUMBER.size)
+        if len(message) < BLOCK_NUMBER.size:
+            break
+        block, k = BLOCK_NUMBER.unpack(message)
+        rows = blocks[block]
+        yield rows, neighbors[rows, :k], scores[rows, :k]
+        done += 1
+    reader.close()
+    failed = [pid for pid in pids if os.waitpid(pid, 0)[1]]
+    if failed or done < len(blocks):
+        raise RuntimeError('%d of %d KNN workers failed' % (len(failed), workers))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+from os import makedirs, path
+
+
+## A sparse matrix is stored in its own directory as raw little-endian arrays
+## which are memory-mapped when loaded:
+##   data.bin     float32 values of the non-zero cells
+##   indices.bin  int32 column (word id) of each value
+##   indptr.bin   int64 offset of each row in data and indices, plus one
+##   obj_ids.txt  the obj_id of each row, one per line
+##   meta.json    shape, number of non-zero values and dtypes
+DATA_TYPE = np.dtype('<f4')
+INDEX_TYPE = np.dtype('<i4')
+INDPTR_TYPE = np.dtype('<i8')
+
+
+class SparseWriter(object):
+    """Writes object vectors one row at a time to a CSR matrix on disk"""
+
+    def __init__(self, matrix_path, width):
+        self.path = matrix_path
+        if not path.isdir(self.path):
+            makedirs(self.path, 0755)
+        self.width = width
+        self.nnz = 0
+        self.data = open(self.path + 'data.bin', 'wb')
+        self.indices = open(self.path + 'indices.bin', 'wb')
+        self.indptr = open(self.path + 'indptr.bin', 'wb')
+        self.obj_ids = open(self.path + 'obj_ids.txt', 'w')
+        self.rows = 0
+        np.zeros(1, dtype=INDPTR_TYPE).tofile(self.indptr)
+
+    def add(self, obj_id, indices, values):
+        """Append a row given the columns and values of its non-zero cells"""
+        indices = np.asarray(indices, dtype=INDEX_TYPE)
+        values = np.asarray(values, dtype=DATA_TYPE)
+        order = np.argsort(indices, kind='mergesort')
+        indices[order].tofile(self.indices)
+        values[order].tofile(self.data)
+        self.nnz += len(indices)
+        np.array([self.nnz], dtype=INDPTR_TYPE).tofile(self.indptr)
+        self.obj_ids.write(obj_id + '\n')
+        self.rows += 1
+
+    def add_array(self, obj_id, array):
+        """Append a dense row"""
+        indices = np.flatnonzero(array)
+        self.add(obj_id, indices, array[indices])
+
+    def close(self):
+        for output in (self.data, self.indices, self.indptr, self.obj_ids):
+            output.close()
+        meta = {'shape': [self.rows, self.width], 'nnz': self.nnz, 'data': DATA_TYPE.str,
+                'indices': INDEX_TYPE.str, 'indptr': INDPTR_TYPE.str}
+        output = open(self.path + 'meta.json', 'w')
+        json.dump(meta, output)
+        output.close()
+
+
+class SparseMatrix(object):
+    """Memory-mapped CSR matrix of object vectors, addressable by obj_id"""
+
+    def __init__(self, matrix_path):
+        self.path = matrix_path
+        meta = json.load(open(self.path + 'meta.json'))
+        self.shape = tuple(meta['shape'])
+        self.nnz = meta['nnz']
+        self.data = self.__map('data.bin', meta['data'], self.nnz)
+        self.indices = self.__map('indices.bin', meta['indices'], self.nnz)
+        self.indptr = self.__map('indptr.bin', meta['indptr'], self.shape[0] + 1)
+        self.obj_ids = [line.rstrip('\n') for line in open(self.path + 'obj_ids.txt')]
+        self.row_index = dict((obj_id, row) for row, obj_id in enumerate(self.obj_ids))
+
+    def __map(self, name, dtype, length):
+        if not length:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path + name, dtype=dtype, mode='r', shape=(length,))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __contains__(self, obj_id):
+        return obj_id in self.row_index
+
+    def row(self, obj_id, normalize=True, top=0, lower=None):
+        """Return the dense vector of an object, like np_load does for .npy files"""
+        row = self.row_index[obj_id]
+        start, end = self.indptr[row], self.indptr[row + 1]
+        array = np.zeros(self.shape[1], dtype=DATA_TYPE)
+        array[self.indices[start:end]] = self.data[start:end]
+        if normalize:
+            return array[top:lower] / array[top:lower].sum()
+        return array[top:lower]
+
+    def row_sums(self):
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return np.bincount(rows, weights=self.data, minlength=self.shape[0])
+
+    def matrix(self, normalize=True):
+        """Return a scipy.sparse.csr_matrix over the memory-mapped arrays.
+        Normalizing divides each row by its sum and copies the values."""
+        from scipy.sparse import csr_matrix
+        data = self.data
+        if normalize:
+            sums = self.row_sums()
+            data = data / np.repeat(sums, np.diff(self.indptr)).astype(DATA_TYPE)
+        return csr_matrix((data, self.indices, self.indptr), shape=self.shape, copy=False)
+
+
+def has_sparse_matrix(matrix_path):
+    return path.isfile(matrix_path + 'meta.json')
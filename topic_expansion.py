@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+import numpy as np
+from os import path
+
+loaded_models = {}
+
+
+class ExpansionModel(object):
+    """The topics of lda_topics.sqlite held in arrays for query expansion:
+    the topics of each word with the word's rank in them, and the top terms of each topic"""
+
+    def __init__(self, topics_file, terms=10):
+        conn = sqlite3.connect(topics_file)
+        conn.text_factory = str
+        c = conn.cursor()
+        tables = set(row[0] for row in c.execute('select name from sqlite_master where type="table"'))
+        if 'topic_words' in tables:
+            rows = c.execute('select word, topic, rank from topic_words order by word, rank, topic').fetchall()
+            top_rows = c.execute('select topic, word, weight, rank from topic_words where rank < ?', (terms,)).fetchall()
+        elif 'topics' in tables and 'word_position' in tables:
+            rows, top_rows = legacy_rows(c, terms)
+        else:
+            c.close()
+            conn.close()
+            raise sqlite3.OperationalError('no topic_words table in %s, run Mallet.parse_topics again' % topics_file)
+        self.word_topics = np.array([row[1] for row in rows], dtype=np.int32)
+        self.word_ranks = np.array([row[2] for row in rows], dtype=np.int32)
+        ## rows of each word in word_topics and word_ranks
+        self.word_index = {}
+        start = 0
+        for end in xrange(1, len(rows) + 1):
+            if end == len(rows) or rows[end][0] != rows[start][0]:
+                self.word_index[rows[start][0]] = (start, end)
+                start = end
+        topic_count = int(self.word_topics.max()) + 1 if len(rows) else 0
+        self.terms = []
+        term_index = {}
+        self.topic_terms = np.full((topic_count, terms), -1, dtype=np.int32)
+        self.topic_weights = np.zeros((topic_count, terms))
+        for topic, word, weight, rank in top_rows:
+            if word not in term_index:
+                term_index[word] = len(self.terms)
+                self.terms.append(word.decode('utf-8'))
+            self.topic_terms[topic, rank] = term_index[word]
+            self.topic_weights[topic, rank] = weight
+        c.close()
+        conn.close()
+
+    def word_topic_ranks(self, word):
+        """Return the topics of a word, best ranked first, and its rank in each"""
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        start, end = self.word_index.get(word, (0, 0))
+        return self.word_topics[start:end], self.word_ranks[start:end]
+
+    def match_topic(self, words):
+        """Return the topic in which the query words rank best, as Searcher.match_topic did:
+        the best topic of a single word, or the topic with the lowest sum of ranks among
+        the topics of all words (or all words but one). None if no topic matches."""
+        if len(words) == 1:
+            topics, ranks = self.word_topic_ranks(words[0])
+            if not len(topics):
+                return None
+            return int(topics[0])
+        rank_sums = {}
+        matches = {}
+        for word in set(words):
+            topics, ranks = self.word_topic_ranks(word)
+            for topic, rank in zip(topics.tolist(), ranks.tolist()):
+                rank_sums[topic] = rank_sums.get(topic, 0) + rank
+                matches[topic] = matches.get(topic, 0) + 1
+        for word_num in (len(words), len(words) - 1):
+            candidates = [(rank_sums[topic], topic) for topic in matches if matches[topic] == word_num]
+            if candidates:
+                return min(candidates)[1]
+        return None
+
+    def expansion(self, topic):
+        """Return the top terms of a topic with their weights"""
+        return dict((self.terms[term], float(weight)) for term, weight in
+                    zip(self.topic_terms[topic], self.topic_weights[topic]) if term >= 0)
+
+
+def legacy_rows(c, terms):
+    """Rows of topic_words read from the topics and word_position tables
+    which Mallet.parse_topics wrote before topic_words"""
+    rows = c.execute('select word, topic, position from word_position order by word, position, topic').fetchall()
+    top_rows = []
+    for topic, words in c.execute('select topic, words from topics').fetchall():
+        weights = json.loads(words)
+        ranked = sorted(weights.iteritems(), key=lambda item: item[1], reverse=True)[:terms]
+        for rank, (word, weight) in enumerate(ranked):
+            top_rows.append((topic, word.encode('utf-8'), float(weight), rank))
+    return rows, top_rows
+
+
+def expansion_model(db_path, terms=10):
+    """Return the expansion model of a database, loaded once per process
+    and reloaded when lda_topics.sqlite changes"""
+    topics_file = db_path + 'lda_topics.sqlite'
+    mtime = path.getmtime(topics_file)
+    key = (db_path, terms)
+    if key not in loaded_models or loaded_models[key][0] != mtime:
+        loaded_models[key] = (mtime, ExpansionModel(topics_file, terms))
+    return loaded_models[key][1]
@@ -4,28 +4,147 @@ from __future__ import division
 import re
 import sys
 import sqlite3
-from data_handler import np_load
+from bisect import insort
+from collections import Counter
+from itertools import imap
+from multiprocessing import Pool
+import numpy as np
+from data_handler import load_arrays, load_topic_matrix, obj_arrays_path
+from corpus_stats import CorpusStats
+from bulk_writer import BulkWriter
+from postings import PostingsWriter
+from sparse_store import SparseWriter, has_sparse_matrix
+from neighbor_store import NeighborWriter, has_neighbor_store, neighbor_store_path
+from similarity import Similarity, MATRIX_MEASURES, share_matrix, share, parallel_top_k
+from instrument import get_instrument
+from word_mapper import compile_lexicon
+from headword_index import build_headword_index
 from glob import glob
-from os import makedirs, listdir, path, fork, waitpid
-from shutil import rmtree
-from operator import itemgetter
-from cPickle import load, dump
+from os import makedirs, listdir, path
 
           
+worker_counter = None
+
+
+def load_stemmer(stemmer):
+    if stemmer:
+        try:
+            from Stemmer import Stemmer
+            return Stemmer(stemmer) # where stemmer is the language selected
+        except KeyError:
+            print >> sys.stderr, "Language not supported by stemmer. No stemming will be done."
+        except ImportError:
+            print >> sys.stderr, "PyStemmer is not installed on your system. No stemming will be done."
+    else:
+        return False
+
+def init_worker(word_map, depth, stemmer, hit_offsets=0):
+    """Set up an index_docs worker process"""
+    global worker_counter
+    worker_counter = WordCounter(word_map, depth, load_stemmer(stemmer), hit_offsets)
+
+def count_words(doc):
+    return worker_counter.count(doc)
+
+
+class WordCounter(object):
+    """Counts the indexed words of each object in a words.sorted file.
+    This is the part of index_docs which runs in worker processes.
+    With hit_offsets, the lowest hit_offsets byte offsets of each word in each
+    object are kept as well."""
+    
+    def __init__(self, word_map, depth, stemmer=False, hit_offsets=0):
+        self.word_map = word_map
+        self.depth = depth
+        self.stemmer = stemmer
+        self.hit_offsets = hit_offsets
+        self.stems = {}
+        
+    def stemm(self, word):
+        """Stem a word once, retrying latin-1 words as utf-8"""
+        if word not in self.stems:
+            try:
+                self.stems[word] = self.stemmer.stemWord(word)
+            except UnicodeDecodeError:
+                self.stems[word] = self.stemmer.stemWord(word.decode('latin-1').encode('utf-8'))
+        return self.stems[word]
+        
+    def count(self, doc):
+        """Return a list of (obj_id, [(word, count), ...], offsets) with objects and words
+        in order of first occurrence, so that the result doesn't depend on dict ordering.
+        offsets is None, or with hit_offsets the sorted byte offsets of each word, in the
+        order of the word counts. The byte offset is the last field of each line."""
+        endslice = 3 + self.depth
+        objects = []
+        counts = {}
+        words = {}
+        offsets = {}
+        for line in open(doc):
+            fields = line.split()
+            word = fields[1]
+            if self.stemmer:
+                word = self.stemm(word)
+            if word in self.word_map:
+                obj_id = ' '.join(fields[2:endslice])
+                if obj_id not in counts:
+                    objects.append(obj_id)
+                    counts[obj_id] = {}
+                    words[obj_id] = []
+                if word not in counts[obj_id]:
+                    counts[obj_id][word] = 1
+                    words[obj_id].append(word)
+                else:
+                    counts[obj_id][word] += 1
+                if self.hit_offsets:
+                    self.add_offset(offsets.setdefault((obj_id, word), []), int(fields[-1]))
+        if not self.hit_offsets:
+            return [(obj_id, [(word, counts[obj_id][word]) for word in words[obj_id]], None) for obj_id in objects]
+        return [(obj_id, [(word, counts[obj_id][word]) for word in words[obj_id]],
+                 [offsets[(obj_id, word)] for word in words[obj_id]]) for obj_id in objects]
+
+    def add_offset(self, word_offsets, offset):
+        """Keep the hit_offsets lowest offsets, since lines are not sorted by position"""
+        if len(word_offsets) < self.hit_offsets:
+            insort(word_offsets, offset)
+        elif offset < word_offsets[-1]:
+            word_offsets.pop()
+            insort(word_offsets, offset)
+
 
 class Indexer(object):
     """Indexes a philologic database and generates numpy arrays for vector space calculations
     as well as stores word hits in a SQLite table to use for ranked relevance search"""
     
     def __init__(self, db, arrays=True, relevance_ranking=True, save_text=False, store_results=False, stopwords=False, stemmer=False, 
-                word_cutoff=0, min_freq=10, min_words=0, max_words=None, min_percent=0, max_percent=100, depth=0):
-        """The depth variable defines how far to go in the tree. The value 0 corresponds to the doc level"""
+                word_cutoff=0, min_freq=10, min_words=0, max_words=None, min_percent=0, max_percent=100, depth=0, sparse_arrays=True,
+                postings=True, memory_limit=512, workers=1, instrument=None, hit_offsets=0):
+        """The depth variable defines how far to go in the tree. The value 0 corresponds to the doc level.
+        With sparse_arrays, all arrays are written to a single CSR matrix in obj_matrix/
+        instead of one .npy file per object in obj_arrays/.
+        With postings, word hits for ranked relevance are written as packed postings in postings/
+        instead of the hits_per_word.sqlite table.
+        memory_limit is the size in MB of the postings buffered in memory before they are
+        sorted and spilled to disk.
+        The corpus is read in two passes: one to count the document frequency of words,
+        which decides the vocabulary, and one in index_docs.
+        With more than one worker, index_docs counts words.sorted files in parallel.
+        instrument times the counting, storing and writing of index_docs,
+        see instrument.get_instrument.
+        hit_offsets is the number of byte offsets of each word in each object written
+        to the hit_offsets table of hit_offsets.sqlite, from which DocInfo reads
+        excerpts without querying PhiloLogic. 0 writes no offsets."""
         
+        self.db_name = db
+        self.instrument = get_instrument(instrument)
         self.db_path = '/var/lib/philologic/databases/' + db + '/'
         self.docs = glob(self.db_path + 'WORK/*words.sorted')
         self.store_results = store_results
         self.arrays = arrays
+        self.sparse_arrays = sparse_arrays
         self.r_r = relevance_ranking
+        self.use_postings = postings
+        self.workers = workers
+        self.hit_offsets = hit_offsets
         self.save_docs = save_text
         if save_text:
             self.save_docs = save_text
@@ -34,14 +153,18 @@ class Indexer(object):
                 makedirs(self.text_path, 0755)
         self.depth = depth
         self.min_words = min_words
+        frequencies = self.read_frequencies()
         if max_words == None:
-            self.max_words = sum([int(line.split()[0]) for line in open(self.db_path + 'WORK/all.frequencies')])
+            self.max_words = sum([count for count, word in frequencies])
         else:
             self.max_words = max_words
         self.stemmer = self.load_stemmer(stemmer)
+        self.stemmer_language = stemmer if self.stemmer else False
+        self.counter = WordCounter(None, depth, self.stemmer, hit_offsets)
         self.word_occurence_in_corpus(min_percent, max_percent)
         self.stopwords = self.get_stopwords(stopwords)
-        self.word_ids(word_cutoff, min_freq)
+        self.word_ids(frequencies, word_cutoff, min_freq)
+        self.counter.word_map = self.word_map
         
         if self.arrays:
             try:
@@ -50,8 +173,17 @@ class Indexer(object):
                 self.float32 = float32
                 self.save = save
                 self.word_num = len(self.word_map)
-                self.array_path = self.db_path + 'obj_arrays/'
-                if not path.isdir(self.array_path):
+                if sparse_arrays:
+                    self.array_path = self.db_path + 'obj_matrix/'
+                else:
+                    self.array_path = self.db_path + 'obj_arrays/'
+                if sparse_arrays and has_sparse_matrix(self.array_path):
+                    print 'There is a matrix from a previous run in the %s directory.' % self.array_path
+                    print 'Please delete it and rerun this script.'
+                    sys.exit()
+                elif sparse_arrays:
+                    self.writer = SparseWriter(self.array_path, self.word_num)
+                elif not path.isdir(self.array_path):
                     makedirs(self.array_path, 0755)
                 elif listdir(self.array_path) != []:
                     print 'There are files from a previous run in the %s directory.' % self.array_path
@@ -62,21 +194,23 @@ class Indexer(object):
                 print >> sys.stderr, "numpy is not installed, numpy arrays won't be generated"
 
             
-        if relevance_ranking:
+        if relevance_ranking and postings:
+            self.postings = PostingsWriter(self.db_path + 'postings/', self.word_map, self.depth,
+                                           buffer_size=memory_limit * 1024 * 1024)
+        elif relevance_ranking:
             self.__init__sqlite()
             self.hits_per_word = {}
+        
+        if hit_offsets:
+            self.offsets_writer = BulkWriter(self.db_path + 'hit_offsets.sqlite', instrument=self.instrument)
+            self.offsets_writer.execute('''create table hit_offsets (word text, obj_id text, byte_offsets text)''')
+            self.offsets_writer.create_index('''create index offsets_obj_word_index on hit_offsets(obj_id, word)''')
+            ## words are stored as counted, so DocInfo stems query words the same way
+            self.offsets_writer.execute('''create table hit_offsets_stemmer (language text)''')
+            self.offsets_writer.insert('hit_offsets_stemmer', (self.stemmer_language or '',))
             
     def load_stemmer(self, stemmer):
-        if stemmer:
-            try:
-                from Stemmer import Stemmer
-                return Stemmer(stemmer) # where stemmer is the language selected
-            except KeyError:
-                print >> sys.stderr, "Language not supported by stemmer. No stemming will be done."
-            except ImportError:
-                print >> sys.stderr, "PyStemmer is not installed on your system. No stemming will be done."
-        else:
-            return False
+        return load_stemmer(stemmer)
             
     def get_stopwords(self, stopwords):
         stopword_list = set([])
@@ -88,15 +222,21 @@ class Indexer(object):
                 stopword_list.add(word)
         return stopword_list
 
-    def word_ids(self, word_cutoff, min_freq):
+    def read_frequencies(self):
+        """Return the (count, word) pairs of all.frequencies"""
+        frequencies = []
+        for line in open(self.db_path + 'WORK/all.frequencies'):
+            fields = line.split()
+            frequencies.append((int(fields[0]), fields[1]))
+        return frequencies
+
+    def word_ids(self, frequencies, word_cutoff, min_freq):
         """Map words to integers"""
         self.word_map = {}
-        endcutoff = len([line for line in open(self.db_path + 'WORK/all.frequencies')]) - word_cutoff
+        endcutoff = len(frequencies) - word_cutoff
         word_id = 0
-        for line_count, line in enumerate(open(self.db_path + 'WORK/all.frequencies')):
+        for line_count, (count, word) in enumerate(frequencies):
             if word_cutoff < line_count < endcutoff:
-                word = line.split()[1]
-                count = int(line.split()[0])
                 if self.stemmer:
                     word = self.stemm(word)
                 if word not in self.stopwords and count > min_freq and word in self.words_to_keep:
@@ -108,36 +248,38 @@ class Indexer(object):
         output.close()
         
     def word_occurence_in_corpus(self, min_percent, max_percent):
-        word_occurence = {}
+        """Count the number of objects each word occurs in. An object never spans
+        two files, so only the objects of the current file are kept in memory."""
+        word_occurence = Counter()
         exclude = re.compile('all.words.sorted')
         endslice = 3 + self.depth
-        obj_num = set([])
+        doc_num = 0
         for doc in self.docs:
             if exclude.search(doc):
                 continue
+            objects_per_word = {}
             for line in open(doc):
                 fields = line.split()
                 word = fields[1]
                 if self.stemmer:
                     word = self.stemm(word)
                 obj_id = ' '.join(fields[2:endslice])
-                if word not in word_occurence:
-                    word_occurence[word] = set([])
-                word_occurence[word].add(obj_id)
-                obj_num.add(obj_id)
-        doc_num = len(obj_num)
+                if word not in objects_per_word:
+                    objects_per_word[word] = set([])
+                objects_per_word[word].add(obj_id)
+            objects = set([])
+            for word in objects_per_word:
+                word_occurence[word] += len(objects_per_word[word])
+                objects.update(objects_per_word[word])
+            doc_num += len(objects)
         self.words_to_keep = set([])
         for word in word_occurence:
-            if min_percent < (len(word_occurence[word]) / doc_num * 100) < max_percent:
+            if min_percent < (word_occurence[word] / doc_num * 100) < max_percent:
                 self.words_to_keep.add(word)
         print len(self.words_to_keep)
         
     def stemm(self, word):
-        try:
-            word = self.stemmer.stemWord(word)
-        except UnicodeDecodeError:
-            word = self.stemmer.stemWord(word.decode('latin-1').encode('utf-8'))
-        return word
+        return self.counter.stemm(word)
 
     def __init__array(self):
         """Create numpy arrays"""
@@ -146,91 +288,116 @@ class Indexer(object):
         
     def make_array(self, obj_id, array):
         """Save numpy arrays to disk"""
+        if self.sparse_arrays:
+            self.writer.add_array(obj_id, array)
+            return
         name = '-'.join(obj_id.split())
         array_location = self.array_path + name + '.npy'
         self.save(array_location, array)
         
     def __init__sqlite(self):
         """Initialize SQLite connection"""
-        self.conn = sqlite3.connect(self.db_path + 'hits_per_word.sqlite')
-        self.conn.text_factory = str 
-        self.c = self.conn.cursor()
+        self.hits_writer = BulkWriter(self.db_path + 'hits_per_word.sqlite', instrument=self.instrument)
         if self.depth:
-            self.c.execute('''create table obj_hits (word text, obj_id text, word_freq int, total_words int)''')
-            self.c.execute('''create index word_obj_index on obj_hits(word)''')
+            self.hits_writer.execute('''create table obj_hits (word text, obj_id text, word_freq int, total_words int)''')
+            self.hits_writer.create_index('''create index word_obj_index on obj_hits(word)''')
         else:
-            self.c.execute('''create table doc_hits (word text, doc_id int, word_freq int, total_words int)''')
-            self.c.execute('''create index word_doc_index on doc_hits(word)''')
+            self.hits_writer.execute('''create table doc_hits (word text, doc_id int, word_freq int, total_words int)''')
+            self.hits_writer.create_index('''create index word_doc_index on doc_hits(word)''')
             
-    def save_text(self, doc_dict):
-        for obj in doc_dict:
+    def save_text(self, objects):
+        for obj, word_freqs, offsets in objects:
             text = ''
-            for word in doc_dict[obj]:
-                words = ' '.join([word for i in range(doc_dict[obj][word])])
+            for word, count in word_freqs:
+                words = ' '.join([word for i in range(count)])
                 text +=  words + ' '
             obj = '-'.join(obj.split())
             output = open(self.text_path + obj + '.txt', 'w')
             output.write(text)
             
-    def index_docs(self): 
-        """Index documents using *words.sorted files in the WORK directory of the Philologic database"""
-        obj_count = 0
-        exclude = re.compile('all.words.sorted')
-        for doc in self.docs:
-            if exclude.search(doc):
-                continue
-            print 'one done'
-            doc_dict = {}
-            endslice = 3 + self.depth
-            for line in open(doc):
-                fields = line.split()
-                word = fields[1]
-                if self.stemmer:
-                    word = self.stemm(word)
-                if word in self.word_map:
-                    doc_id = int(fields[2])
-                    self.doc = doc_id
-                    obj_id = ' '.join(fields[2:endslice])
-                    
-                    if obj_id not in doc_dict:
-                        doc_dict[obj_id] = {}
-                    if word not in doc_dict[obj_id]:
-                        doc_dict[obj_id][word] = 1
+    def store_objects(self, objects, stats):
+        """Write the arrays, hits and statistics of the objects of one file"""
+        if self.save_docs:
+            self.save_text(objects)
+        for obj_id, word_freqs, offsets in objects:
+            doc_id = int(obj_id.split()[0])
+            self.doc = doc_id
+            word_count = sum([count for word, count in word_freqs])
+            stats.add(obj_id, word_count)
+            
+            ## Check if arrays are to be generated
+            dense_array = self.arrays and not self.sparse_arrays and self.min_words < word_count < self.max_words
+            if dense_array:
+                array = self.__init__array()
+            
+            ## Iterate through each word in the doc and populate arrays
+            ## and insert values in SQLite table
+            for word, count in word_freqs:
+                if dense_array:
+                    array[self.word_map[word]] = count
+                if self.r_r and not self.use_postings:
+                    if not self.depth:
+                        self.hits_writer.insert('doc_hits', (word, doc_id, count, word_count))
                     else:
-                        doc_dict[obj_id][word] += 1
+                        self.hits_writer.insert('obj_hits', (word, obj_id, count, word_count))
+            
+            if self.r_r and self.use_postings:
+                self.postings.add_document(obj_id, word_count, word_freqs)
+                self.instrument.count('postings', len(word_freqs))
             
+            if offsets is not None:
+                for (word, _), word_offsets in zip(word_freqs, offsets):
+                    self.offsets_writer.insert('hit_offsets', (word, obj_id, ' '.join(imap(str, word_offsets))))
             
-            if self.save_docs:
-                self.save_text(doc_dict)
-            for obj_id in doc_dict:
-                word_count = sum([i for i in doc_dict[obj_id].values()])
-                
-                ## Check if arrays are to be generated
-                if self.arrays and self.min_words < word_count < self.max_words:
-                    array = self.__init__array()
-                
-                ## Iterate through each word in the doc and populate arrays
-                ## and insert values in SQLite table
-                for word in doc_dict[obj_id]:
-                    if self.arrays and self.min_words < word_count < self.max_words:
-                        array[self.word_map[word]] = doc_dict[obj_id][word]
-                    if self.r_r:
-                        if not self.depth:
-                            self.c.execute('insert into doc_hits values (?,?,?,?)', (word, doc_id, doc_dict[obj_id][word], word_count))
-                        else:
-                            self.c.execute('insert into obj_hits values (?,?,?,?)', (word, obj_id, doc_dict[obj_id][word], word_count))
-                
-                ## Save array only if the word count is higher than self.min_words
-                ## and less then self.max_words
-                if self.arrays and self.min_words < word_count < self.max_words:
-                    self.make_array(obj_id, array)
+            ## Save array only if the word count is higher than self.min_words
+            ## and less then self.max_words
+            if dense_array:
+                self.make_array(obj_id, array)
+            elif self.arrays and self.min_words < word_count < self.max_words:
+                self.writer.add(obj_id, [self.word_map[word] for word, count in word_freqs],
+                                [count for word, count in word_freqs])
+            
+    def index_docs(self): 
+        """Index documents using *words.sorted files in the WORK directory of the Philologic database.
+        With several workers, each file is counted in a worker process and stored here in
+        the same order as in serial mode, so that the output is identical."""
+        stats = CorpusStats(vocabulary=len(self.word_map), depth=self.depth)
+        exclude = re.compile('all.words.sorted')
+        docs = [doc for doc in self.docs if not exclude.search(doc)]
+        if self.workers > 1:
+            pool = Pool(self.workers, init_worker, (self.word_map, self.depth, self.stemmer_language, self.hit_offsets))
+            counted_docs = pool.imap(count_words, docs)
+        else:
+            counted_docs = imap(self.counter.count, docs)
+        for objects in self.instrument.iterate('count', counted_docs):
+            print 'one done'
+            with self.instrument.timer('store'):
+                self.store_objects(objects, stats)
+            self.instrument.count('files')
+            self.instrument.count('objects', len(objects))
+        if self.workers > 1:
+            pool.close()
+            pool.join()
         
-        if self.r_r:
-            self.conn.commit()
-            self.c.close()
+        with self.instrument.timer('close'):
+            if self.arrays and self.sparse_arrays:
+                self.writer.close()
+            stats.save(self.db_path)
+            
+            if self.r_r and self.use_postings:
+                self.postings.close()
+            elif self.r_r:
+                self.hits_writer.close()
+            if self.hit_offsets:
+                self.offsets_writer.close()
+            compile_lexicon(self.db_path + 'WORK/all.frequencies')
+            if path.isfile(self.db_path + 'toms.db'):
+                build_headword_index(self.db_path)
+        self.instrument.emit('index_docs', db=self.db_name, depth=self.depth, workers=self.workers,
+                             vocabulary=len(self.word_map))
         
         if self.store_results:
-            storage = KNN_stored(self.db_path, self.arrays_path)
+            storage = KNN_stored(self.db_name, instrument=self.instrument)
             storage.store_results()
 
 
@@ -239,20 +406,31 @@ class KNN_stored(object):
     
     
     def __init__(self, db, dir_path='/var/lib/philologic/databases/', measure='cosine', dbfile_name=False, limit_results=100, workers=2,
-                use_lda=False, use_only_lda=False):
+                use_lda=False, use_only_lda=False, block_size=256, update=False, neighbor_store=False, instrument=None):
         """The docs_only option lets you specifiy which type of objects you want to generate results for, 
-        full documents, or individual divs."""
-        try:
-            import scipy.spatial.distance
-            #self.distance = scipy.spatial.distance
-            self.measure = getattr(scipy.spatial.distance, measure)
-        except ImportError:
-            print >> sys.stderr, "scipy is not installed, KNN results will not be stored"
+        full documents, or individual divs.
+        block_size is the number of arrays compared at once in each matrix product.
+        workers is the number of processes sharing the computation of the neighbors.
+        With update, existing results are kept to be modified by update_results.
+        With neighbor_store, results are stored as memory-mapped arrays instead of a
+        database, in a directory named after the database file.
+        instrument times the comparisons and writes of store_results,
+        see instrument.get_instrument"""
+        if measure not in MATRIX_MEASURES:
+            try:
+                import scipy.spatial.distance
+                getattr(scipy.spatial.distance, measure)
+            except ImportError:
+                print >> sys.stderr, "scipy is not installed, KNN results will not be stored"
         
         self.db_path = dir_path + db + '/'
+        self.measure_name = measure
         self.limit = limit_results
         self.workers = workers
-        self.lda = use_lda
+        self.block_size = block_size
+        self.lda = use_lda and not use_only_lda
+        self.neighbor_store = neighbor_store
+        self.instrument = get_instrument(instrument)
         
         if dbfile_name:
             self.db_file = self.db_path + dbfile_name
@@ -263,82 +441,127 @@ class KNN_stored(object):
         else:
             self.db_file = self.db_path + measure + '_distance_results.sqlite'
         count = 0
-        while path.isfile(self.db_file):
+        while (path.isfile(self.db_file) or has_neighbor_store(neighbor_store_path(self.db_file))) and not update:
             print '%s already exists' % self.db_file
             count += 1
             self.db_file = re.sub('\d*\.sqlite', str(count) + '.sqlite', self.db_file)
             print 'renaming to %s' % self.db_file
         
         if use_only_lda:
-            arrays_path = self.db_path + '/topic_model/topic_arrays/'
+            self.objects, self.matrix = load_topic_matrix(self.db_path, normalize=True)
         else:
-            arrays_path = self.db_path + 'obj_arrays/'
-        files = listdir(arrays_path)
-        objects = [doc.replace('.npy', '') for doc in files]
-        self.array_list = [(obj.replace('-', ' '), np_load(obj, arrays_path)) for obj in objects]
+            self.objects, self.matrix = load_arrays(obj_arrays_path(self.db_path))
         
         if use_lda and not use_only_lda:
-            array_path = self.db_path + '/topic_model/topic_arrays/'
-            files = listdir(array_path)
-            objects = [doc.replace('.npy', '') for doc in files]
-            self.topic_distribution = dict([(obj.replace('-', ' '), np_load(obj, array_path, normalize=False)) for obj in objects])
+            topic_ids, self.topic_matrix = load_topic_matrix(self.db_path)
+            self.topic_rows = dict((obj, row) for row, obj in enumerate(topic_ids))
         
     def __init__sqlite(self):        
-        self.conn = sqlite3.connect(self.db_file)
-        self.c = self.conn.cursor()
-        self.c.execute('''create table obj_results (obj_id text, neighbor_obj_id text, neighbor_distance real)''')
-        self.c.execute('''create index obj_id_index on obj_results(obj_id)''')
-        self.c.execute('''create index distance_obj_id_index on obj_results(neighbor_distance)''')
-    
-    def write_to_disk(self, obj, results, temp_dir):
-        obj = obj.replace(' ', '-') + '.pickle'
-        output = open(temp_dir + obj, 'w')
-        dump(results, output, -1)
+        self.results_writer = BulkWriter(self.db_file, instrument=self.instrument)
+        self.results_writer.execute('''create table obj_results (obj_id text, neighbor_obj_id text, neighbor_distance real)''')
+        self.results_writer.create_index('''create index obj_id_index on obj_results(obj_id)''')
+        self.results_writer.create_index('''create index distance_obj_id_index on obj_results(neighbor_distance)''')
     
     def store_results(self):
-        """This will load all numpy arrays saved on disk and compute the cosine distance for each
-        array in the corpus"""
-        
-        self.__init__sqlite()
-        temp_dir = self.db_path + 'temp_results/'
-        makedirs(temp_dir, 0755)
-        results = []
-        total = len(self.array_list)
-        done = 0
-        workers = 0
-        arrays = range(total)
-        while done < total:
-            while arrays and workers < self.workers:
-                obj, array = self.array_list[arrays.pop(0)]
-                pid = fork()
-                if pid:
-                    workers += 1
-                if not pid:
-                    full_results = []
-                    for new_obj, new_array in self.array_list:
-                        if obj != new_obj:
-                            result = 1 - self.measure(array, new_array)
-                            if self.lda:
-                                result *= 1 - self.measure(self.topic_distribution[obj], self.topic_distribution[new_obj])
-                            full_results.append((obj, new_obj, result))
-                    results = sorted(full_results, key=itemgetter(2), reverse=True)[:self.limit]
-                    self.write_to_disk(obj, results, temp_dir)
-                    exit()
-            pid,status = waitpid(0,0)
-            workers -= 1
-            done += 1
-           
-        for file in glob(temp_dir + '*'):
-            results = load(open(file))
-            for obj, new_obj, result in results:
-                self.c.execute('insert into obj_results values (?,?,?)', (obj, new_obj, result))
-        self.conn.commit()
-        self.c.close()
-        rmtree(temp_dir)
-        
-        
-        
+        """This will load all numpy arrays saved on disk and compute the similarity
+        between each array in the corpus, keeping the limit_results closest for each"""
+        objects = self.objects
+        topics = None
+        if self.lda:
+            topics = self.topic_matrix[[self.topic_rows[obj] for obj in objects]]
+        if self.neighbor_store:
+            writer = NeighborWriter(neighbor_store_path(self.db_file), objects, max(0, min(self.limit, len(objects) - 1)))
+        else:
+            self.__init__sqlite()
+        for rows, neighbors, scores in self.instrument.iterate('compare', self.__neighbors(self.matrix, topics)):
+            self.instrument.count('pairs_compared', (rows.stop - rows.start) * len(objects))
+            with self.instrument.timer('write'):
+                if self.neighbor_store:
+                    writer.add(rows, neighbors, scores)
+                    self.instrument.count('rows_inserted', neighbors.size)
+                else:
+                    for row, obj in enumerate(objects[rows]):
+                        for neighbor, result in zip(neighbors[row], scores[row]):
+                            self.results_writer.insert('obj_results', (obj, objects[neighbor], float(result)))
+        with self.instrument.timer('close'):
+            if self.neighbor_store:
+                writer.close()
+            else:
+                self.results_writer.close()
+        self.instrument.emit('store_results', db=self.db_path, measure=self.measure_name, objects=len(objects),
+                             limit=self.limit, workers=self.workers)
 
-        
-        
-        
+    def __neighbors(self, matrix, topics, start=0, end=None, columns=None):
+        """Top limit_results neighbors of the rows between start and end among
+        the columns slice of rows, as yielded by Similarity.top_k"""
+        if self.workers > 1:
+            ## Forked workers all read the same copy of the matrix in shared memory
+            matrix = share_matrix(matrix)
+            if topics is not None:
+                topics = share(topics)
+        similarity = Similarity(matrix, measure=self.measure_name, block_size=self.block_size)
+        weights = None
+        if topics is not None:
+            weights = Similarity(topics, measure=self.measure_name, block_size=self.block_size)
+        if self.workers > 1:
+            return parallel_top_k(similarity, self.limit, self.workers, weights, start, end, columns)
+        return similarity.top_k(self.limit, start, end, weights, columns)
+
+    def update_results(self, added=(), removed=()):
+        """Update stored results in place after objects were added to or removed from
+        the arrays. Objects re-indexed with new content should be listed in added.
+        Only the added objects and the objects which lost a neighbor get a new list;
+        every other object is only compared to the added objects, and its list is
+        rewritten when one of them is closer than its current neighbors.
+        Neighbor stores have a fixed number of rows and are rebuilt with store_results."""
+        if self.neighbor_store:
+            raise ValueError('update_results only applies to results databases')
+        objects = self.objects
+        position = dict((obj, row) for row, obj in enumerate(objects))
+        changed = set(added) | set(removed)
+        conn = sqlite3.connect(self.db_file)
+        conn.text_factory = str
+        c = conn.cursor()
+        c.execute('create index if not exists neighbor_obj_id_index on obj_results(neighbor_obj_id)')
+        damaged = set()
+        for obj in changed:
+            c.execute('select obj_id from obj_results where neighbor_obj_id=?', (obj,))
+            damaged.update(row[0] for row in c.fetchall())
+        damaged -= changed
+        c.executemany('delete from obj_results where obj_id=? or neighbor_obj_id=?', [(obj, obj) for obj in changed])
+        c.executemany('delete from obj_results where obj_id=?', [(obj,) for obj in damaged])
+
+        ## Added objects come first, then the damaged ones, then the others
+        new_rows = sorted(position[obj] for obj in set(added) if obj in position)
+        repaired_rows = sorted(position[obj] for obj in damaged if obj in position)
+        first_rows = set(new_rows + repaired_rows)
+        order = new_rows + repaired_rows + [row for row in xrange(len(objects)) if row not in first_rows]
+        objects = [objects[row] for row in order]
+        matrix = self.matrix[order]
+        topics = None
+        if self.lda:
+            topics = self.topic_matrix[[self.topic_rows[obj] for obj in objects]]
+        recomputed = len(new_rows) + len(repaired_rows)
+        for rows, neighbors, scores in self.__neighbors(matrix, topics, 0, recomputed):
+            for row, obj in enumerate(objects[rows]):
+                c.executemany('insert into obj_results values (?,?,?)',
+                              [(obj, objects[neighbor], float(result)) for neighbor, result in zip(neighbors[row], scores[row])])
+
+        if new_rows and recomputed < len(objects):
+            c.execute('select obj_id, min(neighbor_distance), count(*) from obj_results group by obj_id')
+            worst = dict((obj, (distance, count)) for obj, distance, count in c.fetchall())
+            for rows, neighbors, scores in self.__neighbors(matrix, topics, recomputed, None, slice(0, len(new_rows))):
+                for row, obj in enumerate(objects[rows]):
+                    distance, count = worst.get(obj, (None, 0))
+                    closer = [(objects[neighbor], float(result)) for neighbor, result in zip(neighbors[row], scores[row])
+                              if count < self.limit or result > distance]
+                    if not closer:
+                        continue
+                    c.execute('select neighbor_obj_id, neighbor_distance from obj_results where obj_id=?', (obj,))
+                    results = sorted(c.fetchall() + closer, key=lambda result: -result[1])[:self.limit]
+                    c.execute('delete from obj_results where obj_id=?', (obj,))
+                    c.executemany('insert into obj_results values (?,?,?)', [(obj,) + result for result in results])
+        conn.commit()
+        c.close()
+        conn.close()
+        print '%d objects updated in %s' % (recomputed, self.db_file)
@@ -1,50 +1,195 @@
 #!/usr/bin/env python
 
 import subprocess
-import re
+import mmap
+import struct
+from os import path, rename
+from data_handler import file_mtime
+
+
+## Layout of the compiled lexicon, all little-endian:
+##   header   magic, version, number of words, hash table slots, size of the word blob
+##   freqs    one uint64 per word id
+##   offsets  one uint64 per word id plus one, start of each word in the blob
+##   table    one int32 per slot, word id or -1, open addressing on the FNV-1a hash
+##   blob     all words concatenated
+MAGIC = 'PLEX'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQ')
+FNV_OFFSET = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+MASK = 0xffffffffffffffff
+
+lexicons = {}
+
+
+def fnv1a(word):
+    word_hash = FNV_OFFSET
+    for char in bytearray(word):
+        word_hash = ((word_hash ^ char) * FNV_PRIME) & MASK
+    return word_hash
+
+def read_frequencies(frequencies):
+    """Return the words of an all.frequencies file, in line order, and their frequencies"""
+    words = []
+    freqs = []
+    for line in open(frequencies):
+        fields = line.split()
+        freqs.append(int(fields[0]))
+        words.append(fields[1])
+    return words, freqs
+
+def compile_lexicon(frequencies, lexicon_file=None):
+    """Build the binary lexicon of an all.frequencies file, where the
+    id of a word is its line number. This is done by the Indexer."""
+    if lexicon_file is None:
+        lexicon_file = frequencies + '.lex'
+    words, freqs = read_frequencies(frequencies)
+    slots = 1
+    while slots < len(words) * 2:
+        slots *= 2
+    table = [-1] * slots
+    for word_id, word in enumerate(words):
+        slot = fnv1a(word) & (slots - 1)
+        while table[slot] != -1:
+            if words[table[slot]] == word:
+                break
+            slot = (slot + 1) & (slots - 1)
+        else:
+            table[slot] = word_id
+    offsets = [0]
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+    blob = ''.join(words)
+    temp_file = lexicon_file + '.tmp'
+    output = open(temp_file, 'wb')
+    output.write(HEADER.pack(MAGIC, VERSION, len(words), slots, len(blob)))
+    output.write(struct.pack('<%dQ' % len(freqs), *freqs))
+    output.write(struct.pack('<%dQ' % len(offsets), *offsets))
+    output.write(struct.pack('<%di' % slots, *table))
+    output.write(blob)
+    output.close()
+    rename(temp_file, lexicon_file)
+
+def load_lexicon(frequencies):
+    """Return the compiled lexicon of an all.frequencies file, or a lexicon read from
+    the file itself if the compiled one is missing or older than the frequencies.
+    Nothing is written here, since search processes usually can't write in WORK/.
+    Lexicons are loaded once per process, and again when either file changes."""
+    lexicon_file = frequencies + '.lex'
+    mtimes = (file_mtime(frequencies), file_mtime(lexicon_file))
+    if frequencies not in lexicons or lexicons[frequencies][0] != mtimes:
+        if mtimes[1] is not None and mtimes[1] >= mtimes[0]:
+            lexicons[frequencies] = (mtimes, Lexicon(lexicon_file))
+        else:
+            lexicons[frequencies] = (mtimes, TextLexicon(*read_frequencies(frequencies)))
+    return lexicons[frequencies][1]
+
+
+class Lexicon(object):
+    """Memory-mapped word <-> id and frequency lookups"""
+
+    def __init__(self, lexicon_file):
+        lexicon = open(lexicon_file, 'rb')
+        self.map = mmap.mmap(lexicon.fileno(), 0, access=mmap.ACCESS_READ)
+        lexicon.close()
+        magic, version, self.words, self.slots, blob_size = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a compiled lexicon' % lexicon_file)
+        self.freqs = HEADER.size
+        self.offsets = self.freqs + 8 * self.words
+        self.table = self.offsets + 8 * (self.words + 1)
+        self.blob = self.table + 4 * self.slots
+
+    def __len__(self):
+        return self.words
+
+    def word(self, word_id):
+        """Return the word of an id, or None if the id is out of range"""
+        if not 0 <= word_id < self.words:
+            return None
+        start, end = struct.unpack_from('<2Q', self.map, self.offsets + 8 * word_id)
+        return self.map[self.blob + start:self.blob + end]
+
+    def freq(self, word_id):
+        return struct.unpack_from('<Q', self.map, self.freqs + 8 * word_id)[0]
+
+    def word_id(self, word):
+        """Return the id of a word, or None if it is not in the lexicon"""
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        slot = fnv1a(word) & (self.slots - 1)
+        while True:
+            word_id = struct.unpack_from('<i', self.map, self.table + 4 * slot)[0]
+            if word_id == -1:
+                return None
+            start, end = struct.unpack_from('<2Q', self.map, self.offsets + 8 * word_id)
+            if end - start == len(word) and self.map[self.blob + start:self.blob + end] == word:
+                return word_id
+            slot = (slot + 1) & (self.slots - 1)
+
+
+class TextLexicon(object):
+    """Same lookups as Lexicon, held in memory"""
+
+    def __init__(self, words, freqs):
+        self.words = words
+        self.freqs = freqs
+        self.word_ids = {}
+        for word_id, word in enumerate(words):
+            self.word_ids.setdefault(word, word_id)
+
+    def __len__(self):
+        return len(self.words)
+
+    def word(self, word_id):
+        if not 0 <= word_id < len(self.words):
+            return None
+        return self.words[word_id]
+
+    def freq(self, word_id):
+        return self.freqs[word_id]
+
+    def word_id(self, word):
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+        return self.word_ids.get(word)
+
 
 class mapper(object):
-    
+
     def __init__(self, path):
         self.file = path  + 'WORK/all.frequencies'
-        
+        self.lexicon = load_lexicon(self.file)
+
     def __getitem__(self, key):
-        if type(key) is int:
+        if isinstance(key, (int, long)):
             return self._id_grep(key)
         return self._grep(key)
-        
+
     def __iter__(self):
-        word_id = -1
-        for line in open(self.file):
-            word = line.strip().split()[1]
-            word_id += 1
-            yield word, word_id
-        
+        for word_id in xrange(len(self.lexicon)):
+            yield self.lexicon.word(word_id), word_id
+
     def _grep(self, word_key):
-        pattern = re.compile(word_key + '\W')
-        word_id = 0
-        for line in open(self.file):
-            if pattern.search(line):
-                return word_id
-            word_id += 1
-                
+        return self.lexicon.word_id(word_key)
+
     def _id_grep(self, id_key):
-        word_id = 0
-        for line in open(self.file):
-            if word_id == id_key:
-              return line.strip().split()[1]  
-            word_id += 1
-            
+        return self.lexicon.word(id_key)
+
     def id_and_freq(self, word):
-        pattern = re.compile('\W' + word + '\W')
-        word_id = 0
-        for line in open(self.file):
-            if pattern.search(line):
-                fields = line.split()
-                freq = float(line.split()[0])
-                return (word_id, freq)
-            word_id += 1
-            
+        word_id = self.lexicon.word_id(word)
+        if word_id is not None:
+            return (word_id, float(self.lexicon.freq(word_id)))
+
+    def lookup_many(self, words):
+        """Return the (id, frequency) of each word, None for unknown words"""
+        return [self.id_and_freq(word) for word in words]
+
+    def words_for_ids(self, ids):
+        """Return the word of each id"""
+        return [self.lexicon.word(word_id) for word_id in ids]
+
     ## Version with GNU grep
     def sys_grep(self, word_key):
         process = subprocess.Popen(['grep', '-wn', word, self.file], stdout=subprocess.PIPE)